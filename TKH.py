@@ -1,52 +1,480 @@
 import os
 import sys
+import json
 import subprocess
 import time
 import random
-import pyautogui
-import pydirectinput
-from collections import deque
+import heapq
+import itertools
+import queue
+import threading
+import bisect
+import argparse
+import atexit
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import namedtuple
+try:
+    import numpy as np
+    import cv2
+except ImportError:
+    # Only install-deps can run without them; main() says what is missing
+    np = cv2 = None
 
 # --- Initial Setup and Dependency Check ---
 
-def install_dependencies():
+# Maps the import name to the name used to install it with pip
+CORE_PACKAGES = {
+    'numpy': 'numpy',
+    'cv2': 'opencv-python'
+}
+# Only needed to capture and click on a live game; replays run without them
+LIVE_PACKAGES = {
+    'pyautogui': 'pyautogui',
+    'pydirectinput': 'pydirectinput'
+}
+# Only needed for YAML mode files, finding game windows by title and the fast mss capture backend
+OPTIONAL_PACKAGES = {
+    'yaml': 'pyyaml',
+    'pygetwindow': 'pygetwindow',
+    'mss': 'mss'
+}
+
+def missing_packages(required_packages):
+    """
+    Returns the pip names of the packages that are not installed, without importing them.
+    """
+    return [package for module_name, package in required_packages.items() if importlib.util.find_spec(module_name) is None]
+
+def install_dependencies(required_packages):
     """
     Checks if required libraries are installed and installs them if they are not.
     """
-    required_packages = ['pyautogui', 'pydirectinput']
-    
     print("Checking for required Python libraries...")
-    for package in required_packages:
-        try:
-            __import__(package)
+    for module_name, package in required_packages.items():
+        if importlib.util.find_spec(module_name) is not None:
             print(f"  - {package} is already installed.")
-        except ImportError:
-            print(f"  - {package} not found. Attempting to install...")
-            try:
-                subprocess.check_call([sys.executable, "-m", "pip", "install", package])
-                print(f"  - Successfully installed {package}.")
-            except subprocess.CalledProcessError:
-                print(f"  - Failed to install {package}. Please install it manually with 'pip install {package}'.")
-                sys.exit(1)
+            continue
+        print(f"  - {package} not found. Attempting to install...")
+        try:
+            subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+            print(f"  - Successfully installed {package}.")
+        except subprocess.CalledProcessError:
+            print(f"  - Failed to install {package}. Please install it manually with 'pip install {package}'.")
+            sys.exit(1)
+    importlib.invalidate_caches()
+
+def load_core_packages():
+    """
+    Imports numpy and OpenCV once install_dependencies has put them in place.
+    """
+    global np, cv2
+    import numpy as np
+    import cv2
+
+# Where screenshots come from and where clicks go. Screenshots come from a capture
+# backend chosen by CAPTURE_BACKEND (see create_capture_backend), which main() sets up.
+# Clicks go through pydirectinput, imported on the first click. Replays swap in
+# recorded frames and a click recorder.
+screen_source = None
+input_backend = None
+input_backend_lock = threading.Lock()
 
-# Run the dependency check at the very beginning
-install_dependencies()
+def load_input_backend():
+    """
+    Imports the input library the first time a live game clicks. Returns its click function.
+    """
+    global input_backend
+    if input_backend is None:
+        with input_backend_lock:
+            if input_backend is None:
+                import pydirectinput
+
+                # No fixed pause after input calls beyond a short one; waits between actions are handled by the scheduler
+                pydirectinput.PAUSE = 0.05
+                pydirectinput.FAILSAFE = False
+                input_backend = pydirectinput.click
+    return input_backend
+
+def live_click(x, y):
+    load_input_backend()(x, y)
+
+click_sink = live_click
 
 # --- Configuration ---
-pyautogui.PAUSE = 0.5
-pydirectinput.FAILSAFE = False
+# Logging: a background thread batches log lines to disk and rotates the file
+LOG_FILE = "bot_log.txt"
+LOG_FORMAT = "text"  # "text" for plain lines, "json" for one JSON object per line with a timestamp and event type
+LOG_MAX_BYTES = 5 * 1024 * 1024  # The log is rotated once it reaches this size
+LOG_ROTATE_INTERVAL = None  # Seconds after which the log is rotated whatever its size, or None
+LOG_BACKUP_COUNT = 5  # Rotated logs kept as bot_log.txt.1 (newest) to bot_log.txt.5
+LOG_FLUSH_INTERVAL = 1.0  # Lines are collected for up to this long after the first one, then written together
+LOG_QUEUE_SIZE = 10000  # Lines waiting to be written; more are dropped and counted rather than blocking the bot
+
+LOOP_INTERVAL = 0.1  # Longest time the main loop sleeps between ticks
+WAIT_POLL_INTERVAL = 0.1  # How often a wait re-captures the screen to see if it can end early
+
+# Threaded pipeline: capture, detection and clicking each run on their own thread
+CAPTURE_INTERVAL = 0.1  # Shortest time between screenshots taken by the capture thread
+DETECTION_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # Threads that match templates in parallel
+ACTION_QUEUE_SIZE = 8  # Clicks waiting to run; further clicks are dropped until the queue drains
+
+# Region-of-interest search: learned template positions are saved here between runs
+REGION_CACHE_FILE = "tkh_regions.json"
+ROI_MARGIN = 60  # Pixels added around the last hit when searching its region
+ROI_FULL_SEARCH_INTERVAL = 1.0  # Seconds between full-frame searches for a template whose region missed
+ROI_SAVE_INTERVAL = 30  # Seconds between saves of newly learned regions
+
+# Screen capture: "mss" grabs the screen natively and is much faster than "pyautogui";
+# "file" plays a recording (CAPTURE_FILE) as the screen; "auto" picks mss when it is installed
+CAPTURE_BACKEND = "auto"
+CAPTURE_FILE = None  # Recording directory or video for the "file" backend
+
+# Checkpointing: session progress is saved here so a restarted bot resumes its counters, stats and game state
+CHECKPOINT_FILE = "tkh_checkpoint.json"  # None turns checkpointing off
+CHECKPOINT_INTERVAL = 15  # Seconds between checkpoints; a finished game is saved at the next tick
+CHECKPOINT_MAX_AGE = 120  # Older checkpoints resume counters and stats only; the game state and window are found afresh
+
+# Game modes: extra or replacement mode definitions are read from this file if it exists (.json, or .yaml with PyYAML)
+MODES_FILE = "tkh_modes.json"
+
+# Template matching: scales to try for every template, e.g. [0.8, 1.0, 1.25] to cover other DPI settings
+TEMPLATE_SCALES = [1.0]
+COARSE_SCALE = 0.5  # The frame is downsampled by this factor once per tick for the coarse pass
+COARSE_CONFIDENCE_MARGIN = 0.2  # Coarse candidates are kept if they score within this of the confidence
+COARSE_MIN_TEMPLATE_SIZE = 12  # Templates smaller than this after downsampling skip the coarse pass
+
+# Change detection: template matching is skipped while the screen stays the same
+CHANGE_GATE_SIZE = (160, 90)  # Frames are shrunk to this size before comparing them
+CHANGE_GATE_THRESHOLD = 12  # Grey levels any shrunk pixel must move by for the screen to count as changed
+CHANGE_GATE_MAX_AGE = 2.0  # Seconds after which matching runs again even if nothing changed
+
+# Game window anchoring: the window is found by its title bar (crwindow.png)
+GAME_WINDOW_TITLE = "Clash Royale"
+WINDOW_RECHECK_INTERVAL = 60  # Seconds between re-checks of a window that was found
+WINDOW_SEARCH_RETRY_INTERVAL = 5  # Seconds between searches while the window is not found
+REFERENCE_WINDOW_SIZE = (1920, 1080)  # Window size the click offsets were tuned for
+MAX_GAME_WINDOWS = 4  # Most game windows driven at once in multi-window mode
+SHARED_FRAME_TIMEOUT = 1.0  # Longest a multi-window session waits for the next desktop screenshot before using the last one
+
+# Prometheus metrics: served at http://METRICS_HOST:METRICS_PORT/metrics while the bot runs
+METRICS_PORT = None  # e.g. 9464 to turn the endpoint on; None leaves metrics off at no cost
+METRICS_HOST = "127.0.0.1"  # Use "0.0.0.0" to let another machine scrape the bot
 
 # --- Global Functions ---
 
-def log_event(message):
+class LogWriter:
+    """
+    Writes log records to the log file from a background thread, in batches,
+    rotating the file by size or age. Callers only put records on a queue.
+    """
+
+    def __init__(self, path=LOG_FILE, log_format=LOG_FORMAT):
+        self.path = path
+        self.log_format = log_format
+        self.records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.pending = []
+        self.log_file = None
+        self.opened_time = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        """Queues a record for writing. Never waits for the disk."""
+        if self.thread is None:
+            self.start()
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def format(self, record):
+        if self.log_format == "json":
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record["time"]))
+            return json.dumps(dict(record, time=f"{timestamp}.{int(record['time'] % 1 * 1000):03d}"))
+        return f"[https://jlaiii.github.io/TKH/] {record['message']}"
+
+    def run(self):
+        """
+        Waits for a record, then keeps collecting for up to LOG_FLUSH_INTERVAL
+        before writing them all at once. Collected records are kept on
+        self.pending so close() can still write them if the program exits mid-batch.
+        """
+        while True:
+            try:
+                record = self.records.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while True:
+                with self.lock:
+                    self.pending.append(record)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.records.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.write_pending()
+
+    def write_pending(self):
+        """Writes the collected records. Called with self.lock held."""
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            if self.log_file is None:
+                self.open()
+            elif self.rotation_due():
+                self.rotate()
+            self.log_file.write("".join(self.format(record) + "\n" for record in batch))
+            self.log_file.flush()
+        except OSError as e:
+            print(f"[https://jlaiii.github.io/TKH/] ERROR: Could not write to {self.path}: {e}")
+            self.log_file = None
+
+    def open(self):
+        self.log_file = open(self.path, "a")
+        self.opened_time = time.time()
+
+    def rotation_due(self):
+        if self.log_file.tell() >= LOG_MAX_BYTES:
+            return True
+        return LOG_ROTATE_INTERVAL is not None and time.time() - self.opened_time >= LOG_ROTATE_INTERVAL
+
+    def rotate(self):
+        """Renames bot_log.txt to bot_log.txt.1, shifting older backups up and dropping the oldest."""
+        self.log_file.close()
+        for index in range(LOG_BACKUP_COUNT - 1, 0, -1):
+            older = f"{self.path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}")
+        if LOG_BACKUP_COUNT > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def close(self):
+        """Writes whatever is still collected or queued. Called at exit."""
+        with self.lock:
+            while True:
+                try:
+                    self.pending.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            self.write_pending()
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+log_writer = LogWriter()
+
+def log_event(message, event_type="info", **fields):
     """
-    Logs a message to the console and to a log file without a timestamp.
+    Logs a message to the console and queues it for the log file.
+    event_type and any extra fields are kept in JSON logs.
     """
+    session = getattr(session_context, "session", None)
+    if session is not None:
+        message = f"[{session.name}] {message}"
+        fields["session"] = session.name
     log_message = f"[https://jlaiii.github.io/TKH/] {message}"
-    print(log_message)
-    
-    with open("bot_log.txt", "a") as log_file:
-        log_file.write(log_message + "\n")
+    print(log_message + "\n", end="")  # One write, so lines from several threads do not interleave
+
+    record = {"time": time.time(), "type": event_type, "message": message}
+    record.update(fields)
+    log_writer.write(record)
+
+# --- Metrics ---
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+CLICK_ATTEMPT_BUCKETS = [1, 2, 3, 4, 5, 10]
+
+def escape_label_value(value):
+    """Escapes a label value for the Prometheus text format, as state and image names come from mode files."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+def format_metric(name, metric_type, help_text, samples):
+    """
+    Renders one metric in the Prometheus text format.
+    samples is a list of (name suffix, labels dict or None, value) tuples; the
+    suffix is "" except for parts such as a summary's "_sum" and "_count".
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{format_labels(labels)} {value}")
+    return lines
+
+class Counter:
+    """A Prometheus counter, optionally split by one label."""
+
+    metric_type = "counter"
+
+    def __init__(self, name, help_text, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def render(self):
+        with self.lock:
+            samples = [("", {self.label_name: label} if self.label_name else None, value) for label, value in self.values.items()]
+        return format_metric(self.name, self.metric_type, self.help_text, samples)
+
+class Gauge(Counter):
+    """A Prometheus gauge, optionally split by one label."""
+
+    metric_type = "gauge"
+
+    def set(self, value, label=None):
+        with self.lock:
+            self.values[label] = value
+
+class Histogram:
+    """A Prometheus histogram with fixed buckets, optionally split by one label."""
+
+    def __init__(self, name, help_text, buckets, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_name = label_name
+        self.series = {}  # label -> [per-bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, label=None):
+        with self.lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label, (counts, total, count) in self.series.items():
+                labels = {self.label_name: label} if self.label_name else {}
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(dict(labels, le='+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+class Metrics:
+    """
+    Every metric the bot exports. It only exists while the metrics endpoint is on;
+    instrumented code checks `metrics is not None` first, so it costs nothing when off.
+    """
+
+    def __init__(self):
+        self.match_seconds = Histogram("tkh_template_match_seconds", "Time to search for one template in one frame.", LATENCY_BUCKETS, "template")
+        self.screenshot_seconds = Histogram("tkh_screenshot_seconds", "Time to capture one screenshot.", LATENCY_BUCKETS)
+        self.tick_seconds = Histogram("tkh_loop_tick_seconds", "Time from the start of a screen capture to its detections being ready.", LATENCY_BUCKETS)
+        self.clicks = Counter("tkh_clicks_total", "Clicks sent to the game.")
+        self.click_attempts = Histogram("tkh_click_retry_attempts", "Attempts used by click_with_retry, by outcome.", CLICK_ATTEMPT_BUCKETS, "outcome")
+        self.state_seconds = Counter("tkh_game_state_seconds_total", "Time spent in each game state, summed over sessions.", "state")
+        self.game_state = Gauge("tkh_game_state", "Sessions currently in each game state.", "state")
+        self.instruments = [self.match_seconds, self.screenshot_seconds, self.tick_seconds, self.clicks, self.click_attempts, self.state_seconds, self.game_state]
+        self.collectors = []  # Functions returning (name, type, help, samples) families, e.g. the session counters
+        self.session_states = {}  # session name -> (game state, time it was last recorded)
+        self.state_lock = threading.Lock()
+
+    def record_state(self, game_state, current_time, session_name=None):
+        """Adds the time since the session's last call to its previous state and marks the current one."""
+        with self.state_lock:
+            previous = self.session_states.get(session_name)
+            if previous is None:
+                self.game_state.inc(1, game_state)
+            else:
+                previous_state, since = previous
+                self.state_seconds.inc(current_time - since, previous_state)
+                if previous_state != game_state:
+                    self.game_state.inc(-1, previous_state)
+                    self.game_state.inc(1, game_state)
+            self.session_states[session_name] = (game_state, current_time)
+
+    def end_session(self, session_name=None):
+        """Stops counting a session that has finished in the game state gauge."""
+        with self.state_lock:
+            previous = self.session_states.pop(session_name, None)
+            if previous is not None:
+                self.game_state.inc(-1, previous[0])
+
+    def render(self):
+        lines = []
+        for instrument in self.instruments:
+            lines.extend(instrument.render())
+        # Several sessions may report the same family, which must be written as one block
+        families = {}
+        for collector in self.collectors:
+            try:
+                for name, metric_type, help_text, samples in collector():
+                    families.setdefault(name, (metric_type, help_text, []))[2].extend(samples)
+            except Exception as e:
+                lines.append(f"# Collector failed: {e}")
+        for name, (metric_type, help_text, samples) in families.items():
+            lines.extend(format_metric(name, metric_type, help_text, samples))
+        return "\n".join(lines) + "\n"
+
+metrics = None
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics in the Prometheus text format."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics" or metrics is None:
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Keep scrapes out of the console
+
+def start_metrics_server(port, host=METRICS_HOST):
+    """Turns on metrics collection and serves them at http://host:port/metrics."""
+    global metrics, match_timer
+    metrics = Metrics()
+    match_timer = lambda name, seconds: metrics.match_seconds.observe(seconds, name)
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    metrics.collectors.append(lambda: [
+        ("tkh_log_lines_dropped_total", "counter", "Log lines dropped because the log queue was full.", [("", None, log_writer.dropped)])
+    ])
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log_event(f"Metrics are served at http://{host}:{server.server_address[1]}/metrics")
+    return server
 
 def jitter_click(x, y, x_range=20, y_range=20):
     """Perform a click with a random offset (jitter)."""
@@ -54,361 +482,2455 @@ def jitter_click(x, y, x_range=20, y_range=20):
     jitter_y = random.randint(-y_range, y_range)
     jittered_x = x + jitter_x
     jittered_y = y + jitter_y
-    pydirectinput.click(jittered_x, jittered_y)
+    current_session().click(jittered_x, jittered_y)
+    if metrics is not None:
+        metrics.clicks.inc()
 
-def find_image_on_screen(image_path, confidence=0.8, grayscale=False):
+# A template match: its center on screen, its score and the template scale that matched
+Match = namedtuple('Match', ['x', 'y', 'score', 'scale'])
+
+class Frame:
     """
-    Tries to find an image on the screen and returns its center coordinates.
-    Returns None if the image is not found.
+    A captured screenshot as an RGB array, with a grayscale copy made on first use.
+    A frame may be a crop of a larger screenshot; offset is its top-left corner on screen.
     """
-    try:
-        location = pyautogui.locateCenterOnScreen(
-            image_path,
-            confidence=confidence,
-            grayscale=grayscale
-        )
-        return location
-    except pyautogui.ImageNotFoundException:
+
+    def __init__(self, rgb, offset=(0, 0), capture_time=None):
+        self.rgb = rgb
+        self.offset = offset
+        self.capture_time = capture_time if capture_time is not None else time.time()
+        self._gray = None
+        self._coarse = {}
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.rgb, cv2.COLOR_RGB2GRAY)
+        return self._gray
+
+    def coarse(self, grayscale):
+        """Returns the frame downsampled by COARSE_SCALE, made once and shared by every template."""
+        if grayscale not in self._coarse:
+            source = self.gray if grayscale else self.rgb
+            self._coarse[grayscale] = cv2.resize(source, None, fx=COARSE_SCALE, fy=COARSE_SCALE, interpolation=cv2.INTER_AREA)
+        return self._coarse[grayscale]
+
+    def crop(self, left, top, right, bottom):
+        """Returns a view of part of this frame without copying pixels."""
+        cropped = Frame(self.rgb[top:bottom, left:right], (self.offset[0] + left, self.offset[1] + top), self.capture_time)
+        if self._gray is not None:
+            cropped._gray = self._gray[top:bottom, left:right]
+        return cropped
+
+class WindowLocator:
+    """
+    Finds the game window by its title bar once and re-checks it only occasionally,
+    so template matching can be limited to the window and click offsets can be
+    scaled to its size.
+    """
+
+    def __init__(self):
+        self.template = None
+        self.rect = None  # (left, top, right, bottom) on screen
+        self.scale = 1.0
+        self.last_check_time = 0
+
+    def update(self, frame, current_time):
+        """Re-locates the window if a check is due. Returns the current rectangle or None."""
+        if self.template is None:
+            return None
+        interval = WINDOW_RECHECK_INTERVAL if self.rect else WINDOW_SEARCH_RETRY_INTERVAL
+        if current_time - self.last_check_time >= interval:
+            self.last_check_time = current_time
+            self.locate(frame)
+        return self.rect
+
+    def locate(self, frame):
+        """Searches the full frame for the title bar and works out the window rectangle."""
+        title_location = find_image_on_screen(self.template, confidence=0.8, frame=frame)
+        if not title_location:
+            if self.rect:
+                log_event("Game window title bar not found. Searching the full screen until it is found again.")
+            self.rect = None
+            self.scale = 1.0
+            return
+        title_left = title_location[0] - self.template.width // 2
+        title_top = title_location[1] - self.template.height // 2
+        rect, self.scale = self.window_rect(frame, title_left, title_top)
+        if rect != self.rect:
+            log_event(f"Game window located at {rect} (click scale {self.scale:.2f}).")
+        self.rect = rect
+
+    def locate_all(self, frame, limit):
+        """
+        Searches the full frame for up to limit title bars, for multi-window mode.
+        Returns a (rect, scale) pair per window found, ordered left to right, top to bottom.
+        """
+        titles = find_all_images(self.template, frame, confidence=0.8, limit=limit)
+        windows = []
+        for title_left, title_top in titles:
+            (left, top, right, bottom), scale = self.window_rect(frame, title_left, title_top)
+            # A window never reaches past another window's title bar, which matters when the OS gave no size
+            for other_left, other_top in titles:
+                if other_left > left and top <= other_top < bottom:
+                    right = min(right, other_left)
+            for other_left, other_top in titles:
+                if other_top > top and left <= other_left < right:
+                    bottom = min(bottom, other_top)
+            windows.append(((left, top, right, bottom), scale))
+        return sorted(windows, key=lambda window: (window[0][0], window[0][1]))
+
+    def window_rect(self, frame, title_left, title_top):
+        """Works out the (left, top, right, bottom) rectangle and click scale of the window whose title bar starts at the given point."""
+        frame_height, frame_width = frame.rgb.shape[:2]
+        window_size = self.system_window_size(title_left, title_top)
+        if window_size:
+            width, height = window_size
+            scale = height / REFERENCE_WINDOW_SIZE[1]
+        else:
+            # Without the window size, assume the window reaches the bottom-right of the screen
+            width, height = frame_width - title_left, frame_height - title_top
+            scale = 1.0
+        rect = (max(0, title_left), max(0, title_top), min(frame_width, title_left + width), min(frame_height, title_top + height))
+        return rect, scale
+
+    def system_window_size(self, title_left, title_top):
+        """
+        Asks the OS for the size of the game window whose title bar was found.
+        Returns None where pygetwindow is not available.
+        """
+        try:
+            import pygetwindow
+            windows = pygetwindow.getWindowsWithTitle(GAME_WINDOW_TITLE)
+        except Exception:
+            return None
+        if not windows:
+            return None
+        window = min(windows, key=lambda w: abs(w.left - title_left) + abs(w.top - title_top))
+        if window.width <= 0 or window.height <= 0:
+            return None
+        return window.width, window.height
+
+    def resume(self, rect, scale, current_time):
+        """
+        Uses a window position saved by a checkpoint until the next check, which is
+        brought forward to WINDOW_SEARCH_RETRY_INTERVAL in case the window moved.
+        """
+        self.rect = tuple(rect)
+        self.scale = scale
+        self.last_check_time = current_time - WINDOW_RECHECK_INTERVAL + WINDOW_SEARCH_RETRY_INTERVAL
+
+    def crop(self, frame):
+        """Limits a full-screen frame to the game window, if it is known."""
+        if self.rect is None:
+            return frame
+        return frame.crop(*self.rect)
+
+    def scale_offset(self, offset_x, offset_y):
+        """Scales a click offset tuned for REFERENCE_WINDOW_SIZE to the current window."""
+        return round(offset_x * self.scale), round(offset_y * self.scale)
+
+window_locator = WindowLocator()
+
+# --- Capture Backends ---
+# A capture backend is a callable that returns the screen as a new RGB array,
+# which the caller owns and can hold for as long as it needs.
+
+CAPTURE_BACKENDS = ["auto", "pyautogui", "mss", "file"]
+
+class PyAutoGuiCapture:
+    """
+    Captures with pyautogui, which builds a new PIL image of the whole screen every time.
+    Slow, but works wherever pyautogui does.
+    """
+
+    packages = {'pyautogui': 'pyautogui'}
+
+    def __init__(self):
+        self.pyautogui = None
+
+    def __call__(self):
+        if self.pyautogui is None:
+            import pyautogui
+            pyautogui.PAUSE = 0
+            self.pyautogui = pyautogui
+        image = self.pyautogui.screenshot()
+        return np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+
+class MssCapture:
+    """
+    Captures with mss, which grabs the screen natively (XShmGetImage shared memory on
+    Linux, BitBlt on Windows) and converts it straight to RGB without building an image.
+    Captures the primary monitor, like pyautogui.
+    """
+
+    packages = {'mss': 'mss'}
+
+    def __init__(self, monitor=1):
+        self.monitor = monitor
+        # mss handles belong to the thread that opened them
+        self.local = threading.local()
+
+    def __call__(self):
+        grabber = getattr(self.local, "grabber", None)
+        if grabber is None:
+            import mss
+            # mss 10 renamed the factory to MSS and deprecated mss()
+            grabber = self.local.grabber = (mss.MSS if hasattr(mss, "MSS") else mss.mss)()
+        shot = grabber.grab(grabber.monitors[self.monitor])
+        bgra = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        return cv2.cvtColor(bgra, cv2.COLOR_BGRA2RGB)
+
+def resolve_capture_backend(name):
+    """Turns "auto" into mss when it is installed and pyautogui otherwise."""
+    if name == "auto":
+        return "mss" if importlib.util.find_spec("mss") is not None else "pyautogui"
+    return name
+
+def capture_packages(name):
+    """Returns the packages a capture backend needs, as {import name: pip name}."""
+    return {"pyautogui": PyAutoGuiCapture.packages, "mss": MssCapture.packages}.get(resolve_capture_backend(name), {})
+
+def create_capture_backend(name=CAPTURE_BACKEND, path=CAPTURE_FILE):
+    """
+    Creates a capture backend by name. Nothing is imported until the first capture.
+    Raises ValueError for an unknown name or a "file" backend without a recording.
+    """
+    name = resolve_capture_backend(name)
+    if name == "pyautogui":
+        return PyAutoGuiCapture()
+    if name == "mss":
+        return MssCapture()
+    if name == "file":
+        if not path:
+            raise ValueError("the file capture backend needs a recording (--capture-file)")
+        return ReplaySource(path).capture
+    raise ValueError(f"unknown capture backend '{name}' (choose from {', '.join(CAPTURE_BACKENDS)})")
+
+class FrameProvider:
+    """
+    Owns screen capture. It keeps the newest screenshot so lookups can share it
+    instead of grabbing the screen again, and captures one at a time even when
+    several threads ask for a fresh frame.
+    Also keeps per-tick timing counters for the stats block, where a tick is one
+    captured frame going through detection.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.lock = threading.Lock()
+        self.ticks = 0
+        self.captures = 0
+        self.total_tick_time = 0.0
+        self.total_capture_time = 0.0
+
+    def record_tick(self, tick_time):
+        """Records how long a frame took from the start of its capture to its detections being published."""
+        self.total_tick_time += tick_time
+        self.ticks += 1
+        if metrics is not None:
+            metrics.tick_seconds.observe(tick_time)
+
+    def get_frame(self):
+        """Returns the newest frame, capturing one if there is none yet."""
+        frame = self.frame
+        if frame is None:
+            return self.refresh()
+        return frame
+
+    def refresh(self):
+        """Captures a fresh frame, e.g. to see what a click changed."""
+        with self.lock:
+            # Stamped with the time the capture started, as the screen may change while it runs
+            start_time = time.time()
+            capture_start = time.perf_counter()
+            screen = Frame(screen_source(), capture_time=start_time)
+            capture_time = time.perf_counter() - capture_start
+            self.total_capture_time += capture_time
+            if metrics is not None:
+                metrics.screenshot_seconds.observe(capture_time)
+            self.captures += 1
+            window_locator.update(screen, time.time())
+            self.frame = window_locator.crop(screen)
+            return self.frame
+
+    def average_tick_time(self):
+        return self.total_tick_time / self.ticks if self.ticks else 0
+
+    def average_capture_time(self):
+        return self.total_capture_time / self.captures if self.captures else 0
+
+    def captures_per_tick(self):
+        return self.captures / self.ticks if self.ticks else 0
+
+frame_provider = FrameProvider()
+
+class RegionCache:
+    """
+    Remembers where each template was last found so the next lookup can search a
+    small window around that spot before falling back to the whole frame.
+    """
+
+    def __init__(self, path=REGION_CACHE_FILE):
+        self.path = path
+        self.regions = {}
+        self.last_full_search_times = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.last_save_time = time.time()
+        self.region_hits = 0
+        self.full_searches = 0
+        self.deferred_searches = 0  # Misses whose full-frame search was put off; see ChangeGate.detect
+
+    def load(self):
+        """Loads regions learned in previous runs. A missing or damaged file is ignored."""
+        try:
+            with open(self.path, "r") as region_file:
+                data = json.load(region_file)
+            self.regions = {name: tuple(box) for name, box in data.items() if len(box) == 4}
+        except (OSError, ValueError, TypeError):
+            self.regions = {}
+
+    def save(self):
+        """Writes the learned regions to disk. A cache without a path is never saved."""
+        if self.path is None:
+            self.dirty = False
+            return
+        with self.lock:
+            data = {name: list(box) for name, box in self.regions.items()}
+        try:
+            write_file_atomically(self.path, json.dumps(data))
+            self.dirty = False
+        except OSError as e:
+            log_event(f"ERROR: Could not save learned search regions: {e}", event_type="error")
+        self.last_save_time = time.time()
+
+    def save_if_due(self, current_time):
+        if self.dirty and current_time - self.last_save_time >= ROI_SAVE_INTERVAL:
+            self.save()
+
+    def checkpoint(self):
+        with self.lock:
+            return {name: list(box) for name, box in self.regions.items()}
+
+    def restore(self, regions):
+        """Takes regions from a checkpoint, which are at least as new as any saved with save()."""
+        with self.lock:
+            self.regions.update((name, tuple(box)) for name, box in regions.items() if len(box) == 4)
+
+    def search_window(self, name, frame):
+        """
+        Returns the (left, top, right, bottom) window around the last hit in the
+        frame's own coordinates, or None if there is none.
+        """
+        box = self.regions.get(name)
+        if box is None:
+            return None
+        frame_height, frame_width = frame.rgb.shape[:2]
+        x, y, width, height = box
+        x -= frame.offset[0]
+        y -= frame.offset[1]
+        left = max(0, x - ROI_MARGIN)
+        top = max(0, y - ROI_MARGIN)
+        right = min(frame_width, x + width + ROI_MARGIN)
+        bottom = min(frame_height, y + height + ROI_MARGIN)
+        if right - left < width or bottom - top < height:
+            return None
+        return left, top, right, bottom
+
+    def claim_full_search(self, name):
+        """
+        Returns True if a full-frame search for the template should run now.
+        Templates with a known region only widen to the full frame once per
+        ROI_FULL_SEARCH_INTERVAL, so an absent button stays cheap to look for.
+        """
+        with self.lock:
+            current_time = time.time()
+            if name in self.regions and current_time - self.last_full_search_times.get(name, 0) < ROI_FULL_SEARCH_INTERVAL:
+                self.deferred_searches += 1
+                return False
+            self.last_full_search_times[name] = current_time
+            self.full_searches += 1
+            return True
+
+    def record_hit(self, name, x, y, width, height, in_region):
+        box = (int(x), int(y), int(width), int(height))
+        with self.lock:
+            if in_region:
+                self.region_hits += 1
+            if self.regions.get(name) != box:
+                self.regions[name] = box
+                self.dirty = True
+
+    def hit_rate(self):
+        total = self.region_hits + self.full_searches
+        return self.region_hits / total if total else 0
+
+region_cache = RegionCache()
+
+def best_match(haystack, needle):
+    """
+    Runs normalised template matching and returns (score, top-left corner) of the
+    best match, or None if the needle does not fit in the haystack.
+    """
+    if needle.shape[0] > haystack.shape[0] or needle.shape[1] > haystack.shape[1]:
+        return None
+    result = cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+    _, max_value, _, max_location = cv2.minMaxLoc(result)
+    return max_value, max_location
+
+def best_match_in_window(haystack, needle, left, top, right, bottom):
+    """Like best_match but only searches a window, returning frame coordinates."""
+    match = best_match(haystack[top:bottom, left:right], needle)
+    if match is None:
         return None
+    score, location = match
+    return score, (location[0] + left, location[1] + top)
+
+def search_region(frame, template, confidence, grayscale, window):
+    """Fine search of every template scale inside a small window. Returns (score, location, variant) or None."""
+    haystack = frame.gray if grayscale else frame.rgb
+    best = None
+    for variant in template.variants:
+        needle = variant.gray if grayscale else variant.rgb
+        match = best_match_in_window(haystack, needle, *window)
+        if match and match[0] >= confidence and (best is None or match[0] > best[0]):
+            best = (match[0], match[1], variant)
+    return best
+
+def search_frame(frame, template, confidence, grayscale):
+    """
+    Searches the whole frame at every template scale. A coarse pass on the
+    downsampled frame finds a candidate, then a fine pass confirms it at full
+    resolution. Returns (score, location, variant) or None.
+    """
+    haystack = frame.gray if grayscale else frame.rgb
+    frame_height, frame_width = haystack.shape[:2]
+    best = None
+    for variant in template.variants:
+        coarse_needle = variant.coarse_gray if grayscale else variant.coarse_rgb
+        needle = variant.gray if grayscale else variant.rgb
+        if coarse_needle is None:
+            match = best_match(haystack, needle)
+        else:
+            coarse_match = best_match(frame.coarse(grayscale), coarse_needle)
+            if coarse_match is None or coarse_match[0] < confidence - COARSE_CONFIDENCE_MARGIN:
+                continue
+            # Confirm the candidate at full resolution in a window a little larger than the template
+            margin = int(2 / COARSE_SCALE) + 2
+            x = int(coarse_match[1][0] / COARSE_SCALE)
+            y = int(coarse_match[1][1] / COARSE_SCALE)
+            window = (max(0, x - margin), max(0, y - margin), min(frame_width, x + variant.width + margin), min(frame_height, y + variant.height + margin))
+            match = best_match_in_window(haystack, needle, *window)
+        if match and match[0] >= confidence and (best is None or match[0] > best[0]):
+            best = (match[0], match[1], variant)
+    return best
+
+detection_pool = ThreadPoolExecutor(max_workers=DETECTION_WORKERS, thread_name_prefix="detect")
+
+# Called with (template name, seconds) after every template search when set, e.g. by the benchmark
+match_timer = None
+
+def match_template(frame, template, confidence, grayscale, regions):
+    """
+    Finds one template in a frame, searching the region where it was last seen
+    (as learned by the RegionCache regions) first. Returns its Match in screen
+    coordinates, or None.
+    """
+    if match_timer is None:
+        return locate_template(frame, template, confidence, grayscale, regions)
+    match_start = time.perf_counter()
+    match = locate_template(frame, template, confidence, grayscale, regions)
+    match_timer(template.name, time.perf_counter() - match_start)
+    return match
+
+def locate_template(frame, template, confidence, grayscale, regions):
+    """The untimed search behind match_template."""
+    try:
+        found = None
+        in_region = False
+        window = regions.search_window(template.name, frame)
+        if window:
+            found = search_region(frame, template, confidence, grayscale, window)
+            in_region = found is not None
+        if found is None and regions.claim_full_search(template.name):
+            found = search_frame(frame, template, confidence, grayscale)
     except Exception as e:
-        log_event(f"ERROR: An error occurred while finding image: {e}")
+        log_event(f"ERROR: An error occurred while finding image: {e}", event_type="error")
         return None
+    if found is None:
+        return None
+    score, location, variant = found
+    screen_x = location[0] + frame.offset[0]
+    screen_y = location[1] + frame.offset[1]
+    regions.record_hit(template.name, screen_x, screen_y, variant.width, variant.height, in_region)
+    return Match(screen_x + variant.width // 2, screen_y + variant.height // 2, score, variant.scale)
+
+def match_templates(frame, searches):
+    """
+    Finds several templates in one frame in a single call, spreading them over
+    the detection worker pool.
+    searches is a list of (template, confidence, grayscale) tuples. Returns a dict
+    of template name to its best Match, or None where the template was not found.
+    Returned coordinates are always screen coordinates, even for a cropped frame.
+    """
+    # Looked up here because the pool threads are not bound to the caller's session
+    regions = current_session().region_cache
+    if len(searches) > 1 and DETECTION_WORKERS > 1:
+        found = detection_pool.map(lambda search: match_template(frame, *search, regions), searches)
+    else:
+        found = [match_template(frame, *search, regions) for search in searches]
+    return {template.name: match for (template, _, _), match in zip(searches, found)}
+
+def screen_thumbnail(frame):
+    """Shrinks a frame to a small grayscale image for cheap change detection."""
+    small = cv2.resize(frame.rgb, CHANGE_GATE_SIZE, interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_RGB2GRAY)
+
+def thumbnails_differ(first, second):
+    """
+    The largest difference is used rather than the mean so a single button
+    appearing counts as a change.
+    """
+    if first is None or second is None or first.shape != second.shape:
+        return True
+    return int(cv2.absdiff(first, second).max()) >= CHANGE_GATE_THRESHOLD
+
+class ChangeGate:
+    """
+    Sits in front of match_templates and reuses the last detections while the
+    screen has not visibly changed, forcing a fresh match after CHANGE_GATE_MAX_AGE.
+    Detections with a miss whose full-frame search was put off by the RegionCache
+    are never reused, so a button that moved is still found within ROI_FULL_SEARCH_INTERVAL.
+    """
 
-def click_with_retry(image_path, confidence, grayscale, offset_x=0, offset_y=0, attempts=5, delay_between_attempts=1.0):
+    def __init__(self):
+        self.thumbnail = None
+        self.detections = None
+        self.complete = False
+        self.searches = None
+        self.last_match_time = 0
+        self.skipped_ticks = 0
+        self.matched_ticks = 0
+
+    def detect(self, frame, searches, current_time):
+        """Returns detections for the frame, matching templates only if the screen changed."""
+        thumbnail = screen_thumbnail(frame)
+        if (searches is self.searches
+                and self.complete
+                and current_time - self.last_match_time < CHANGE_GATE_MAX_AGE
+                and not thumbnails_differ(thumbnail, self.thumbnail)):
+            self.skipped_ticks += 1
+            return self.detections
+        regions = current_session().region_cache
+        deferred_searches = regions.deferred_searches
+        self.detections = match_templates(frame, searches)
+        self.complete = regions.deferred_searches == deferred_searches
+        self.thumbnail = thumbnail
+        self.searches = searches
+        self.last_match_time = current_time
+        self.matched_ticks += 1
+        return self.detections
+
+    def skip_rate(self):
+        total = self.skipped_ticks + self.matched_ticks
+        return self.skipped_ticks / total if total else 0
+
+change_gate = ChangeGate()
+
+def find_image_on_screen(template, confidence=0.8, grayscale=False, frame=None):
+    """
+    Tries to find a preloaded template on the screen and returns its center coordinates.
+    Searches the given frame, or the current tick's frame if none is given.
+    Returns None if the image is not found.
+    """
+    if frame is None:
+        frame = current_session().frame_provider.get_frame()
+    return match_templates(frame, [(template, confidence, grayscale)])[template.name]
+
+def find_all_images(template, frame, confidence=0.8, limit=1):
+    """
+    Finds up to limit separate, non-overlapping copies of a template in a frame,
+    best first, in grayscale at every template scale.
+    Returns their top-left corners in screen coordinates.
+    """
+    candidates = []
+    for variant in template.variants:
+        if variant.height > frame.gray.shape[0] or variant.width > frame.gray.shape[1]:
+            continue
+        result = cv2.matchTemplate(frame.gray, variant.gray, cv2.TM_CCOEFF_NORMED)
+        for _ in range(limit):
+            _, score, _, (x, y) = cv2.minMaxLoc(result)
+            if score < confidence:
+                break
+            candidates.append((score, x, y, variant.width, variant.height))
+            # Blank out every position overlapping this match so the next one is elsewhere
+            result[max(0, y - variant.height + 1):y + variant.height, max(0, x - variant.width + 1):x + variant.width] = -1
+    found = []
+    for score, x, y, width, height in sorted(candidates, reverse=True):
+        if len(found) == limit:
+            break
+        if all(abs(x - other_x) >= width or abs(y - other_y) >= height for other_x, other_y, _, _ in found):
+            found.append((x, y, width, height))
+    return [(x + frame.offset[0], y + frame.offset[1]) for x, y, _, _ in found]
+
+class Scheduler:
+    """
+    A queue of actions, each with the earliest time it may run. The main loop runs
+    whatever is due every tick, so detection keeps going between timed clicks.
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.counter = itertools.count()
+
+    def schedule(self, delay, action, description=""):
+        """Queues action to run no earlier than delay seconds from now."""
+        heapq.heappush(self.queue, (time.time() + delay, next(self.counter), description, action))
+
+    def run_due(self, current_time):
+        """Runs every queued action whose time has come."""
+        while self.queue and self.queue[0][0] <= current_time:
+            _, _, description, action = heapq.heappop(self.queue)
+            try:
+                action()
+            except Exception as e:
+                log_event(f"ERROR: Scheduled action '{description}' failed: {e}", event_type="error")
+
+    def next_due_time(self):
+        return self.queue[0][0] if self.queue else None
+
+    def time_until_next(self, limit):
+        """Returns how long to wait for the next queued action, capped at limit."""
+        next_due = self.next_due_time()
+        if next_due is None:
+            return limit
+        return max(0, min(limit, next_due - time.time()))
+
+scheduler = Scheduler()
+
+class GameSession:
+    """
+    Everything the bot keeps per game window: where the window is, its frames,
+    learned search regions, change gate, scheduler, action thread and how it
+    clicks. Single-window mode uses the module-level components; multi-window
+    mode gives every window its own session, bound to the threads that serve it.
+    """
+
+    def __init__(self, name, window_locator, frame_provider, region_cache, change_gate, scheduler, actions, click, frame_feed=None):
+        self.name = name
+        self.window_locator = window_locator
+        self.frame_provider = frame_provider
+        self.region_cache = region_cache
+        self.change_gate = change_gate
+        self.scheduler = scheduler
+        self.actions = actions
+        self.click = click
+        self.frame_feed = frame_feed  # LatestQueue filled with this window's frames, or None to capture its own
+
+session_context = threading.local()
+
+def current_session():
+    """
+    Returns the session bound to this thread, or in single-window mode one made
+    of the module-level components (looked up each time, as replays swap them).
+    """
+    session = getattr(session_context, "session", None)
+    if session is None:
+        session = GameSession(None, window_locator, frame_provider, region_cache, change_gate, scheduler, actions, lambda x, y: click_sink(x, y))
+    return session
+
+def start_session_thread(target, name):
+    """Starts a daemon thread bound to the same session as the thread starting it."""
+    session = getattr(session_context, "session", None)
+
+    def run():
+        session_context.session = session
+        target()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+class LatestQueue:
+    """
+    A one-slot hand-off between threads that only keeps the newest item.
+    Putting an item replaces one that has not been taken yet.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Returns the newest item, waiting up to timeout for one. Returns None on timeout."""
+        with self.condition:
+            if self.item is None:
+                self.condition.wait(timeout)
+            item = self.item
+            self.item = None
+            return item
+
+# Detections for one frame, handed from the detection thread to the state machine
+DetectionEvent = namedtuple('DetectionEvent', ['capture_time', 'detections', 'searches'])
+
+class DetectionPipeline:
+    """
+    Runs capture and detection on background threads. The capture thread keeps
+    only the newest frame, and the detection thread matches it and publishes the
+    newest detections for the state machine to consume.
+    """
+
+    def __init__(self, searches, frame_feed=None):
+        """
+        frame_feed, if given, is a LatestQueue another thread fills with frames,
+        e.g. a window's slice of a shared desktop screenshot; no capture thread
+        is started then.
+        """
+        self.searches = searches
+        self.capture = frame_feed is None
+        self.frames = LatestQueue() if frame_feed is None else frame_feed
+        self.events = LatestQueue()
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [start_session_thread(self.detect_loop, "detection")]
+        if self.capture:
+            self.threads.append(start_session_thread(self.capture_loop, "capture"))
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+
+    def capture_loop(self):
+        while self.running:
+            capture_start = time.time()
+            try:
+                self.frames.put(current_session().frame_provider.refresh())
+            except Exception as e:
+                log_event(f"ERROR: An error occurred while capturing the screen: {e}", event_type="error")
+            remaining = CAPTURE_INTERVAL - (time.time() - capture_start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def detect_loop(self):
+        gate = current_session().change_gate
+        frame_provider = current_session().frame_provider
+        while self.running:
+            frame = self.frames.get(timeout=CAPTURE_INTERVAL)
+            if frame is None:
+                continue
+            searches = self.searches  # May be replaced by the state machine at any time
+            detections = gate.detect(frame, searches, frame.capture_time)
+            frame_provider.record_tick(time.time() - frame.capture_time)
+            self.events.put(DetectionEvent(frame.capture_time, detections, searches))
+
+    def next_event(self, timeout):
+        """Returns the newest detections, or None if none arrive within timeout."""
+        return self.events.get(timeout)
+
+class ActionExecutor:
+    """
+    Runs clicks and click-and-wait sequences one at a time on their own thread,
+    so detection keeps running while an action waits for the screen to change.
+    """
+
+    def __init__(self):
+        self.actions = queue.Queue(maxsize=ACTION_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.last_finished_time = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = start_session_thread(self.run, "actions")
+
+    def submit(self, action, description, on_done=None):
+        """
+        Queues action to run on the executor thread. on_done, if given, is called
+        there with the action's return value. Returns False if the queue is full.
+        """
+        with self.lock:
+            try:
+                self.actions.put_nowait((action, description, on_done))
+            except queue.Full:
+                log_event(f"Action queue is full. Dropping action: {description}.")
+                return False
+            self.pending += 1
+        return True
+
+    def busy(self):
+        """Returns True while any action is queued or running."""
+        return self.pending > 0
+
+    def run(self):
+        while True:
+            action, description, on_done = self.actions.get()
+            try:
+                result = action()
+                if on_done:
+                    on_done(result)
+            except Exception as e:
+                log_event(f"ERROR: Action '{description}' failed: {e}", event_type="error")
+            finally:
+                with self.lock:
+                    self.last_finished_time = time.time()
+                    self.pending -= 1
+
+actions = ActionExecutor()
+
+def wait_until(condition, timeout):
+    """
+    Re-captures the screen until condition(frame) is true, or timeout seconds pass.
+    The timeout is the upper bound that used to be a fixed sleep.
+    Returns True if the condition was met.
+    """
+    deadline = time.time() + timeout
+    while True:
+        if condition(current_session().frame_provider.refresh()):
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(WAIT_POLL_INTERVAL, remaining))
+
+def wait_for_transition(timeout):
+    """
+    Waits until a screen transition has finished: the screen changed and then
+    stopped changing. A screen that never changes waits the whole timeout, the
+    fixed sleep this replaces, as the game may simply not have started the transition yet.
+    Returns True if it finished before the timeout.
+    """
+    start_thumbnail = screen_thumbnail(current_session().frame_provider.get_frame())
+    previous_thumbnail = None
+    changed = False
+
+    def transition_finished(frame):
+        nonlocal previous_thumbnail, changed
+        thumbnail = screen_thumbnail(frame)
+        settled = changed and not thumbnails_differ(thumbnail, previous_thumbnail)
+        changed = changed or thumbnails_differ(thumbnail, start_thumbnail)
+        previous_thumbnail = thumbnail
+        return settled
+
+    return wait_until(transition_finished, timeout)
+
+def click_with_retry(template, confidence, grayscale, offset_x=0, offset_y=0, attempts=5, delay_between_attempts=1.0):
     """
     Finds and clicks an image on the screen with multiple retries.
+    Offsets are given for REFERENCE_WINDOW_SIZE and scaled to the game window.
     Returns True if the click was successful, False otherwise.
     """
+    offset_x, offset_y = current_session().window_locator.scale_offset(offset_x, offset_y)
     for attempt in range(attempts):
-        location = find_image_on_screen(image_path, confidence=confidence, grayscale=grayscale)
+        location = find_image_on_screen(template, confidence=confidence, grayscale=grayscale)
         if location:
             click_x = location[0] + offset_x
             click_y = location[1] + offset_y
             log_event(f"Attempt {attempt + 1}/{attempts}: Clicking button at {location}...")
             jitter_click(click_x, click_y)
-            time.sleep(random.uniform(0.5, 1.0))
-            # Wait a moment and re-check if the screen has changed
-            time.sleep(delay_between_attempts)
+
             # A simple way to check if the click worked is to see if the button is still there.
             # This is not foolproof but can help in many cases.
-            new_location = find_image_on_screen(image_path, confidence=confidence, grayscale=grayscale)
-            if not new_location or (abs(new_location[0] - location[0]) > 50 or abs(new_location[1] - location[1]) > 50):
+            def button_gone(frame):
+                new_location = find_image_on_screen(template, confidence=confidence, grayscale=grayscale, frame=frame)
+                return not new_location or (abs(new_location[0] - location[0]) > 50 or abs(new_location[1] - location[1]) > 50)
+
+            if wait_until(button_gone, random.uniform(0.5, 1.0) + delay_between_attempts):
                 log_event("Click appears to have been successful.")
+                if metrics is not None:
+                    metrics.click_attempts.observe(attempt + 1, "success")
                 return True
         else:
-            log_event(f"Attempt {attempt + 1}/{attempts}: Button not found. Retrying in {delay_between_attempts} seconds...")
-            time.sleep(delay_between_attempts)
+            log_event(f"Attempt {attempt + 1}/{attempts}: Button not found. Retrying for up to {delay_between_attempts} seconds...")
+            wait_until(lambda frame: find_image_on_screen(template, confidence=confidence, grayscale=grayscale, frame=frame) is not None, delay_between_attempts)
     
     log_event(f"Failed to click the button after {attempts} attempts. Moving on.")
+    if metrics is not None:
+        metrics.click_attempts.observe(attempts, "failure")
     return False
 
-def click_battle_button(image_paths, game_mode):
+def click_battle_button(templates, second_click=None):
+    """
+    Finds and clicks the battle button once. second_click, if given, is the
+    offset of a further click after the screen changes, e.g. to pick 2v2 mode.
+    Returns True if the click was successful, False otherwise.
+    """
+    window = current_session().window_locator
+    battle_button_location = find_image_on_screen(templates['battle_button_image'], confidence=0.6)
+    if battle_button_location:
+        log_event("Clicking the main Battle button.")
+        offset_x, offset_y = window.scale_offset(0, -200)
+        jitter_click(battle_button_location[0] + offset_x, battle_button_location[1] + offset_y) # First click
+
+        def battle_button_gone(frame):
+            return find_image_on_screen(templates['battle_button_image'], confidence=0.6, frame=frame) is None
+
+        # Modes such as 2v2 need a second click on the screen the Battle button opens
+        if second_click:
+            wait_for_transition(1) # Wait for the screen to transition
+            log_event("Selecting the game mode with an additional click.")
+            # Use the saved location to perform the second click
+            offset_x, offset_y = window.scale_offset(*second_click)
+            jitter_click(battle_button_location[0] + offset_x, battle_button_location[1] + offset_y)
+            button_gone = wait_until(battle_button_gone, random.uniform(1.0, 2.0))
+        else:
+            button_gone = wait_until(battle_button_gone, 1)
+        
+        # A simple check to see if the battle button is still there. If it's not, the click likely succeeded.
+        if button_gone:
+            log_event("Battle button click successful. Searching for game...")
+            return True
+        else:
+            log_event("Battle button still visible after click.")
+            return False
+    else:
+        log_event("Battle button not found when trying to click.")
+        return False
+
+def check_image_assets(image_paths):
+    """
+    Checks if all required image assets exist and provides a status report.
+    Reports missing assets and returns True if all are found, False otherwise.
+    """
+    found_assets = []
+    missing_assets = []
+    for name, path in image_paths.items():
+        if os.path.exists(path):
+            found_assets.append(f"  - '{name}' image found successfully.")
+        else:
+            missing_assets.append(f"  - ERROR: '{name}' image NOT found at: {path}")
+
+    return found_assets, missing_assets
+
+# One scaled copy of a template, with downsampled copies for the coarse pass (None if too small)
+TemplateVariant = namedtuple('TemplateVariant', ['scale', 'width', 'height', 'rgb', 'gray', 'coarse_rgb', 'coarse_gray'])
+
+class Template:
+    """
+    An image asset decoded once into colour and grayscale arrays ready for matching,
+    plus a scaled copy for every entry in TEMPLATE_SCALES.
+    """
+
+    def __init__(self, name, path, rgb):
+        self.name = name
+        self.path = path
+        self.rgb = rgb
+        self.gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        self.height, self.width = rgb.shape[:2]
+        self.variants = [self.make_variant(scale) for scale in TEMPLATE_SCALES]
+
+    def make_variant(self, scale):
+        if scale == 1.0:
+            rgb = self.rgb
+        else:
+            interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+            rgb = cv2.resize(self.rgb, None, fx=scale, fy=scale, interpolation=interpolation)
+        gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+        height, width = rgb.shape[:2]
+        coarse_rgb = coarse_gray = None
+        if min(width, height) * COARSE_SCALE >= COARSE_MIN_TEMPLATE_SIZE:
+            coarse_rgb = cv2.resize(rgb, None, fx=COARSE_SCALE, fy=COARSE_SCALE, interpolation=cv2.INTER_AREA)
+            coarse_gray = cv2.cvtColor(coarse_rgb, cv2.COLOR_RGB2GRAY)
+        return TemplateVariant(scale, width, height, rgb, gray, coarse_rgb, coarse_gray)
+
+class TemplateRegistry:
+    """
+    Holds every image asset, decoded once at startup, keyed by its name in image_paths.
+    """
+
+    def __init__(self):
+        self.templates = {}
+
+    def __getitem__(self, name):
+        return self.templates[name]
+
+    def load(self, image_paths):
+        """
+        Decodes every asset into memory.
+        Returns a list of error messages for assets that are corrupt or unreadable.
+        """
+        errors = []
+        for name, path in image_paths.items():
+            bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+            if bgr is None or bgr.size == 0:
+                errors.append(f"  - ERROR: '{name}' image at {path} is corrupt or unreadable.")
+                continue
+            self.templates[name] = Template(name, path, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
+        return errors
+
+def format_duration(seconds):
+    """
+    Formats a duration in seconds into a string of days, hours, minutes, and seconds.
+    """
+    days = int(seconds // 86400)
+    hours = int((seconds % 86400) // 3600)
+    minutes = int((seconds % 3600) // 60)
+    seconds = int(seconds % 60)
+    
+    parts = []
+    if days > 0:
+        parts.append(f"{days} day{'s' if days > 1 else ''}")
+    if hours > 0:
+        parts.append(f"{hours} hour{'s' if hours > 1 else ''}")
+    if minutes > 0:
+        parts.append(f"{minutes} minute{'s' if minutes > 1 else ''}")
+    parts.append(f"{seconds} second{'s' if seconds > 1 or seconds == 0 else ''}")
+
+    return ", ".join(parts)
+
+# --- Statistics ---
+
+class StreamingQuantile:
+    """
+    Estimates one quantile of a stream of values in constant memory using the
+    P-squared algorithm (Jain & Chlamtac, 1985), without keeping the values.
+    """
+
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        heights = self.heights
+        if len(heights) < 5:
+            bisect.insort(heights, value)
+            return
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(heights, value) - 1
+        for index in range(cell + 1, 5):
+            self.positions[index] += 1
+        for index in range(5):
+            self.desired[index] += self.increments[index]
+        for index in range(1, 4):
+            offset = self.desired[index] - self.positions[index]
+            if ((offset >= 1 and self.positions[index + 1] - self.positions[index] > 1)
+                    or (offset <= -1 and self.positions[index - 1] - self.positions[index] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = self.linear(index, step)
+                heights[index] = height
+                self.positions[index] += step
+
+    def parabolic(self, index, step):
+        heights, positions = self.heights, self.positions
+        return heights[index] + step / (positions[index + 1] - positions[index - 1]) * (
+            (positions[index] - positions[index - 1] + step) * (heights[index + 1] - heights[index]) / (positions[index + 1] - positions[index])
+            + (positions[index + 1] - positions[index] - step) * (heights[index] - heights[index - 1]) / (positions[index] - positions[index - 1])
+        )
+
+    def linear(self, index, step):
+        heights, positions = self.heights, self.positions
+        return heights[index] + step * (heights[index + step] - heights[index]) / (positions[index + step] - positions[index])
+
+    def value(self):
+        if not self.heights:
+            return 0
+        if len(self.heights) < 5:
+            return self.heights[int(round(self.quantile * (len(self.heights) - 1)))]
+        return self.heights[2]
+
+    def checkpoint(self):
+        return {"heights": list(self.heights), "positions": list(self.positions), "desired": list(self.desired)}
+
+    def restore(self, data):
+        self.heights = list(data["heights"])
+        self.positions = list(data["positions"])
+        self.desired = list(data["desired"])
+
+class RunningStat:
+    """
+    Count, mean, min, max and median/95th percentile estimates of a stream of
+    values, kept in constant memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.p50 = StreamingQuantile(0.5)
+        self.p95 = StreamingQuantile(0.95)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.p50.add(value)
+        self.p95.add(value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "min": self.minimum or 0,
+            "max": self.maximum or 0,
+            "p50": self.p50.value(),
+            "p95": self.p95.value()
+        }
+
+    def checkpoint(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.minimum,
+            "max": self.maximum,
+            "p50": self.p50.checkpoint(),
+            "p95": self.p95.checkpoint()
+        }
+
+    def restore(self, data):
+        self.count = data["count"]
+        self.total = data["total"]
+        self.minimum = data["min"]
+        self.maximum = data["max"]
+        self.p50.restore(data["p50"])
+        self.p95.restore(data["p95"])
+
+class RollingWindow:
+    """
+    Counts events over the last window_seconds in fixed time buckets, so old
+    events fall out of the total without each one being stored.
+    """
+
+    def __init__(self, window_seconds, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.bucket_count = int(window_seconds // bucket_seconds)
+        self.counts = [0] * self.bucket_count
+        self.bucket_ids = [None] * self.bucket_count
+
+    def add(self, event_time, amount=1):
+        bucket_id = int(event_time // self.bucket_seconds)
+        slot = bucket_id % self.bucket_count
+        if self.bucket_ids[slot] != bucket_id:
+            self.bucket_ids[slot] = bucket_id
+            self.counts[slot] = 0
+        self.counts[slot] += amount
+
+    def total(self, current_time):
+        current_bucket = int(current_time // self.bucket_seconds)
+        return sum(
+            count for count, bucket_id in zip(self.counts, self.bucket_ids)
+            if bucket_id is not None and 0 <= current_bucket - bucket_id < self.bucket_count
+        )
+
+    def checkpoint(self):
+        return {"bucket_seconds": self.bucket_seconds, "counts": list(self.counts), "bucket_ids": list(self.bucket_ids)}
+
+    def restore(self, data):
+        # Buckets are numbered from the epoch, so they line up across restarts unless the bucket size changed
+        if data["bucket_seconds"] == self.bucket_seconds and len(data["counts"]) == self.bucket_count:
+            self.counts = list(data["counts"])
+            self.bucket_ids = list(data["bucket_ids"])
+
+class SessionStats:
+    """
+    The bot's running totals and aggregates. Every update and snapshot takes the
+    same time and memory however long the bot has been running.
+    """
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time if start_time is not None else time.time()
+        self.games_completed = 0
+        self.total_cards_placed = 0
+        self.find_times = RunningStat()
+        self.battle_durations = RunningStat()
+        self.games_last_hour = RollingWindow(3600, 60)
+        self.games_last_day = RollingWindow(86400, 900)
+        self.games_last_week = RollingWindow(7 * 86400, 3600)
+
+    def record_find_time(self, seconds):
+        self.find_times.add(seconds)
+
+    def record_game(self, battle_duration, finish_time=None):
+        finish_time = finish_time if finish_time is not None else time.time()
+        self.games_completed += 1
+        self.battle_durations.add(battle_duration)
+        for window in (self.games_last_hour, self.games_last_day, self.games_last_week):
+            window.add(finish_time)
+
+    def record_cards(self, count=1):
+        self.total_cards_placed += count
+
+    def snapshot(self, current_time=None):
+        """Returns every statistic as a plain dict."""
+        current_time = current_time if current_time is not None else time.time()
+        runtime = current_time - self.start_time
+        return {
+            "runtime_seconds": runtime,
+            "games_completed": self.games_completed,
+            "cards_placed": self.total_cards_placed,
+            "cards_per_game": self.total_cards_placed / self.games_completed if self.games_completed else 0,
+            "games_per_hour": self.games_completed / runtime * 3600 if runtime > 0 else 0,
+            "games_last_hour": self.games_last_hour.total(current_time),
+            "games_last_24_hours": self.games_last_day.total(current_time),
+            "games_last_7_days": self.games_last_week.total(current_time),
+            "game_find_time": self.find_times.snapshot(),
+            "battle_duration": self.battle_durations.snapshot()
+        }
+
+    def checkpoint(self, current_time):
+        """Returns everything needed to rebuild these statistics, as a plain dict safe to hand to another thread."""
+        return {
+            "runtime_seconds": current_time - self.start_time,
+            "games_completed": self.games_completed,
+            "cards_placed": self.total_cards_placed,
+            "find_times": self.find_times.checkpoint(),
+            "battle_durations": self.battle_durations.checkpoint(),
+            "games_last_hour": self.games_last_hour.checkpoint(),
+            "games_last_day": self.games_last_day.checkpoint(),
+            "games_last_week": self.games_last_week.checkpoint()
+        }
+
+    def restore(self, data, current_time):
+        """
+        Continues from a checkpoint. The runtime carries on from the saved one, so
+        time the bot was down does not count against games per hour.
+        """
+        self.start_time = current_time - data["runtime_seconds"]
+        self.games_completed = data["games_completed"]
+        self.total_cards_placed = data["cards_placed"]
+        self.find_times.restore(data["find_times"])
+        self.battle_durations.restore(data["battle_durations"])
+        self.games_last_hour.restore(data["games_last_hour"])
+        self.games_last_day.restore(data["games_last_day"])
+        self.games_last_week.restore(data["games_last_week"])
+
+# --- Checkpointing ---
+
+CHECKPOINT_VERSION = 1
+
+def write_file_atomically(path, text):
+    """
+    Replaces path with text so that a crash at any point leaves either the old
+    file or the new one, never a partial write: the text goes to a temporary
+    file in the same folder, is flushed to disk, then renamed over path.
+    The new file keeps the old one's permissions, or gets the usual ones for a new file.
+    """
+    while True:
+        temporary_path = f"{os.path.abspath(path)}.{random.getrandbits(32):08x}.tmp"
+        try:
+            # Created like any new file, so the umask decides its permissions
+            file_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(file_descriptor, "w") as temporary_file:
+            temporary_file.write(text)
+            temporary_file.flush()
+            os.fsync(temporary_file.fileno())
+        try:
+            os.chmod(temporary_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+        raise
+
+class Checkpointer:
+    """
+    Keeps every session's progress in one compact file so a restarted bot can
+    carry on where it stopped. Sessions hand over a snapshot now and then; a
+    background thread writes the newest ones, so the game loop never waits for the disk.
+    """
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = threading.Event()
+        self.thread = None
+
+    def load(self):
+        """Reads the last checkpoint. A missing, damaged or outdated file is ignored."""
+        try:
+            with open(self.path, "r") as checkpoint_file:
+                data = json.load(checkpoint_file)
+            if data.get("version") != CHECKPOINT_VERSION:
+                raise ValueError(f"unsupported checkpoint version {data.get('version')}")
+            self.sessions = dict(data["sessions"])
+        except FileNotFoundError:
+            self.sessions = {}
+        except (OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            log_event(f"Ignoring checkpoint {self.path}: {e}")
+            self.sessions = {}
+
+    def resume(self, session_name):
+        """Returns the saved progress of a session, or None."""
+        return self.sessions.get(session_name or "main")
+
+    def update(self, session_name, progress):
+        """Hands over a session's newest progress to be written. Never waits for the disk."""
+        if self.thread is None:
+            self.start()
+        with self.lock:
+            self.sessions[session_name or "main"] = progress
+        self.pending.set()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="checkpointer", daemon=True)
+                self.thread.start()
+                atexit.register(self.close)
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            self.write()
+
+    def write(self):
+        with self.lock:
+            data = {"version": CHECKPOINT_VERSION, "time": time.time(), "sessions": dict(self.sessions)}
+        with self.write_lock:
+            try:
+                write_file_atomically(self.path, json.dumps(data, separators=(",", ":")))
+            except (OSError, TypeError, ValueError) as e:
+                log_event(f"ERROR: Could not save checkpoint {self.path}: {e}", event_type="error")
+
+    def close(self):
+        """Writes the newest progress, after any write already under way. Called at exit."""
+        self.pending.clear()
+        self.write()
+
+checkpointer = None
+
+# --- Game Modes ---
+
+# Built-in game modes. Each mode lists its states; each state lists, in priority
+# order, the transitions it checks on every tick:
+#   {"found": template}                     the template is on screen
+#   {"missing": template, "for": seconds}   the template has been gone that long
+#   {"nothing_found": True}                 none of the state's templates is on screen
+# A transition may also wait "after" seconds in the state, "log" a message, "do" a
+# list of actions and go "to" another state. "common" transitions are checked first
+# in every state that does not set "common": False. A mode can "extend" another
+# and replace its title, settings, templates, common transitions or single states.
+# Actions: battle_started, battle_finished, place_cards, click, click_battle_button.
+DEFAULT_GAME_MODES = {
+    "1v1": {
+        "title": "1v1 Mode (Classic)",
+        "initial": "unknown",
+        "battle_second_click": None,  # Extra click offset after the Battle button, e.g. to pick a mode
+        "templates": {
+            "in_battle_image": {"confidence": 0.9, "grayscale": False},
+            "ok_button_image": {"confidence": 0.5, "grayscale": True},
+            "battle_button_image": {"confidence": 0.7, "grayscale": False}
+        },
+        "common": [
+            {"found": "in_battle_image", "to": "in_battle"},
+            {"found": "ok_button_image", "log": "Clicking OK button to return to main menu.",
+             "do": ["battle_finished", {"click": {"template": "ok_button_image", "offset_x": -30}}], "to": "returning_to_menu"}
+        ],
+        "states": {
+            "unknown": {
+                "log": "Status: Unknown or loading screen.",
+                "transitions": [
+                    # Transition screens can briefly show a Battle button that is not clickable yet
+                    {"found": "battle_button_image", "after": 3, "do": ["click_battle_button"], "to": "not_in_battle"}
+                ]
+            },
+            "not_in_battle": {
+                "log": "Status: Detected main menu. Initiating new game...",
+                "transitions": [
+                    {"found": "battle_button_image", "after": 5, "do": ["click_battle_button"], "to": "not_in_battle"},
+                    {"nothing_found": True, "to": "unknown"}
+                ]
+            },
+            "in_battle": {
+                "common": False,
+                "enter": ["battle_started"],
+                "repeat": {"while_found": "in_battle_image", "every": 3,
+                           "do": [{"place_cards": {"offset": [300, -100], "drag": [0, -300], "delay": 2}}]},
+                "transitions": [
+                    {"missing": "in_battle_image", "for": 5, "to": "battle_ended_waiting_for_results",
+                     "waiting_log": "Temporarily lost in-battle detection. Waiting for stability...",
+                     "log": "In-battle detection lost for 5+ seconds. Battle likely ended."}
+                ]
+            },
+            "battle_ended_waiting_for_results": {
+                "transitions": [
+                    {"found": "battle_button_image", "do": ["battle_finished", "click_battle_button"], "to": "not_in_battle"},
+                    {"nothing_found": True, "to": "unknown"}
+                ]
+            },
+            "returning_to_menu": {
+                "transitions": [
+                    {"found": "battle_button_image", "do": ["click_battle_button"], "to": "not_in_battle"},
+                    {"nothing_found": True, "to": "unknown"}
+                ]
+            }
+        }
+    },
+    "2v2": {
+        "extends": "1v1",
+        "title": "2v2 Mode",
+        "battle_second_click": [150, -400],
+        "templates": {
+            "two_v_two_end_image": {"confidence": 0.8, "grayscale": True}
+        },
+        "common": [
+            {"found": "in_battle_image", "to": "in_battle"},
+            {"found": "two_v_two_end_image", "log": "Clicking 2v2 end button.",
+             "do": ["battle_finished", {"click": {"template": "two_v_two_end_image"}}], "to": "returning_to_menu"},
+            {"found": "ok_button_image", "log": "Clicking OK button to return to main menu.",
+             "do": ["battle_finished", {"click": {"template": "ok_button_image", "offset_x": -30}}], "to": "returning_to_menu"}
+        ]
+    },
+    "1v1_trophy_road": {
+        "extends": "1v1",
+        "title": "1v1 Trophy Road Mode",
+        "templates": {
+            "play_again_image": {"confidence": 0.8, "grayscale": False}
+        },
+        "common": [
+            {"found": "in_battle_image", "to": "in_battle"},
+            {"found": "play_again_image", "log": "Clicking Play Again button.",
+             "do": ["battle_finished", {"click": {"template": "play_again_image"}}], "to": "returning_to_menu"},
+            {"found": "ok_button_image", "log": "Clicking OK button to return to main menu.",
+             "do": ["battle_finished", {"click": {"template": "ok_button_image", "offset_x": -30}}], "to": "returning_to_menu"}
+        ]
+    }
+}
+
+MODE_ACTIONS = ["battle_started", "battle_finished", "place_cards", "click", "click_battle_button"]
+# Actions that act on where the template was found, so only "found" transitions and "repeat" can use them
+MATCH_ACTIONS = ["place_cards"]
+
+game_modes = DEFAULT_GAME_MODES
+
+def read_game_modes(path):
     """
-    Finds and clicks the battle button once, including a second click for 2v2 mode.
-    Returns True if the click was successful, False otherwise.
+    Returns the built-in modes plus the modes in the file at path, which replace
+    built-in modes of the same name. A missing file just gives the built-in modes.
+    YAML files need PyYAML; JSON files need nothing extra.
     """
-    battle_button_location = find_image_on_screen(image_paths['battle_button_image'], confidence=0.6)
-    if battle_button_location:
-        log_event("Clicking the main Battle button.")
-        jitter_click(battle_button_location[0] + 0, battle_button_location[1] - 200) # First click
-        time.sleep(1) # Wait for the screen to transition
-        
-        # Special handling for 2v2 mode
-        if game_mode == "2v2":
-            log_event("Selecting 2v2 mode with an additional click.")
-            # Use the saved location to perform the second click
-            jitter_click(battle_button_location[0] + 150, battle_button_location[1] - 400)
-            time.sleep(random.uniform(1.0, 2.0))
-        
-        # A simple check to see if the battle button is still there. If it's not, the click likely succeeded.
-        if not find_image_on_screen(image_paths['battle_button_image'], confidence=0.6):
-            log_event("Battle button click successful. Searching for game...")
-            return True
+    modes = dict(DEFAULT_GAME_MODES)
+    if not path or not os.path.exists(path):
+        return modes
+    with open(path, "r") as modes_file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(f"{path} is a YAML file, which needs PyYAML. Install it with 'pip install pyyaml' or use JSON.")
+            data = yaml.safe_load(modes_file)
         else:
-            log_event("Battle button still visible after click.")
-            return False
-    else:
-        log_event("Battle button not found when trying to click.")
-        return False
+            data = json.load(modes_file)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} must map mode names to mode definitions.")
+    modes.update(data)
+    return modes
 
-def check_image_assets(image_paths):
+def resolve_mode(modes, name, seen=()):
+    """Returns the definition of a mode with everything it extends merged in."""
+    if name not in modes:
+        raise ValueError(f"Unknown game mode '{name}'.")
+    if name in seen:
+        raise ValueError(f"Game mode '{name}' extends itself.")
+    definition = modes[name]
+    if "extends" not in definition:
+        return definition
+    base = resolve_mode(modes, definition["extends"], seen + (name,))
+    merged = dict(base, **definition)
+    merged["templates"] = dict(base.get("templates", {}), **definition.get("templates", {}))
+    merged["states"] = dict(base.get("states", {}), **definition.get("states", {}))
+    del merged["extends"]
+    return merged
+
+# One compiled transition; kind is "found", "missing" or "nothing_found"
+Transition = namedtuple('Transition', ['kind', 'template', 'duration', 'after', 'target', 'actions', 'log', 'waiting_log'])
+
+# One compiled state: the searches to run while in it, and its transitions in priority order
+CompiledState = namedtuple('CompiledState', ['name', 'log', 'enter', 'repeat', 'transitions', 'searches'])
+
+class StateMachine:
     """
-    Checks if all required image assets exist and provides a status report.
-    Reports missing assets and returns True if all are found, False otherwise.
+    A game mode compiled from its definition, plus where it currently is.
+    Compiling works out the templates each state can react to, so only those are
+    matched while in it, and checks every state, template and action name.
     """
-    found_assets = []
-    missing_assets = []
-    for name, path in image_paths.items():
-        if os.path.exists(path):
-            found_assets.append(f"  - '{name}' image found successfully.")
+
+    def __init__(self, mode_name, modes, templates):
+        definition = resolve_mode(modes, mode_name)
+        self.name = mode_name
+        self.title = definition.get("title", mode_name)
+        self.battle_second_click = definition.get("battle_second_click")
+        if self.battle_second_click is not None:
+            self.check_pair(f"Mode '{mode_name}'", "battle_second_click", self.battle_second_click)
+        self.search_settings = {}
+        for template_name, settings in definition.get("templates", {}).items():
+            try:
+                template = templates[template_name]
+            except KeyError:
+                raise ValueError(f"Mode '{mode_name}' uses unknown image '{template_name}'.")
+            confidence = self.check_number(f"Mode '{mode_name}'", f"confidence of {template_name}", settings.get("confidence", 0.8))
+            self.search_settings[template_name] = (template, confidence, settings.get("grayscale", False))
+        state_definitions = definition.get("states", {})
+        common = definition.get("common", [])
+        self.states = {}
+        for state_name, state in state_definitions.items():
+            transition_definitions = (common if state.get("common", True) else []) + state.get("transitions", [])
+            transitions = [self.compile_transition(state_name, item, state_definitions) for item in transition_definitions]
+            repeat = None
+            if "repeat" in state:
+                repeat = (self.template_name(state_name, state["repeat"]["while_found"]),
+                          self.check_number(f"State '{state_name}' of mode '{mode_name}'", "every", state["repeat"].get("every", 0)),
+                          self.compile_actions(state_name, state["repeat"].get("do", []), has_match=True))
+            used = [transition.template for transition in transitions if transition.template] + ([repeat[0]] if repeat else [])
+            searches = [self.search_settings[name] for name in dict.fromkeys(used)]
+            self.states[state_name] = CompiledState(state_name, state.get("log"), self.compile_actions(state_name, state.get("enter", [])),
+                                                    repeat, transitions, searches)
+        self.initial = definition.get("initial", "unknown")
+        if self.initial not in self.states:
+            raise ValueError(f"Mode '{mode_name}' starts in unknown state '{self.initial}'.")
+        self.state = self.initial
+        self.state_since = 0  # The first state counts as long settled, so "after" does not delay startup
+        self.missing_since = {}
+        self.next_repeat_time = 0
+
+    def template_name(self, state_name, template_name):
+        if template_name not in self.search_settings:
+            raise ValueError(f"State '{state_name}' of mode '{self.name}' uses '{template_name}', which is not in the mode's templates.")
+        return template_name
+
+    def check_number(self, where, key, value):
+        """Returns value if it is a number, for settings such as "after" and "delay"."""
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{where} sets {key} to {value!r}, which is not a number.")
+        return value
+
+    def check_pair(self, where, key, value):
+        """Returns value if it is an [x, y] pair of numbers, for offsets such as "drag"."""
+        if (not isinstance(value, (list, tuple)) or len(value) != 2
+                or any(isinstance(number, bool) or not isinstance(number, (int, float)) for number in value)):
+            raise ValueError(f"{where} sets {key} to {value!r}, which is not an [x, y] pair of numbers.")
+        return value
+
+    def compile_transition(self, state_name, item, state_definitions):
+        if "found" in item:
+            kind, template = "found", self.template_name(state_name, item["found"])
+        elif "missing" in item:
+            kind, template = "missing", self.template_name(state_name, item["missing"])
+        elif item.get("nothing_found"):
+            kind, template = "nothing_found", None
         else:
-            missing_assets.append(f"  - ERROR: '{name}' image NOT found at: {path}")
+            raise ValueError(f"A transition of state '{state_name}' in mode '{self.name}' has no found, missing or nothing_found condition.")
+        where = f"State '{state_name}' of mode '{self.name}'"
+        target = item.get("to", state_name)
+        if target not in state_definitions:
+            raise ValueError(f"{where} goes to unknown state '{target}'.")
+        duration = self.check_number(where, "for", item.get("for", 0))
+        after = self.check_number(where, "after", item.get("after", 0))
+        return Transition(kind, template, duration, after, target,
+                          self.compile_actions(state_name, item.get("do", []), has_match=kind == "found"), item.get("log"), item.get("waiting_log"))
 
-    return found_assets, missing_assets
+    def compile_actions(self, state_name, items, has_match=False):
+        """
+        Turns "name" and {"name": argument} entries into (name, argument) pairs.
+        has_match says whether the actions run with a found template to act on.
+        """
+        where = f"State '{state_name}' of mode '{self.name}'"
+        actions = []
+        for item in items:
+            name, argument = (item, {}) if isinstance(item, str) else next(iter(item.items()))
+            if name not in MODE_ACTIONS:
+                raise ValueError(f"{where} uses unknown action '{name}'.")
+            if not isinstance(argument, dict):
+                raise ValueError(f"{where} gives '{name}' the setting {argument!r}; actions take a mapping of settings.")
+            if name in MATCH_ACTIONS and not has_match:
+                raise ValueError(f"{where} uses '{name}' where no image was found; "
+                                 f"it can only be used in a \"found\" transition or \"repeat\".")
+            if name == "click":
+                self.template_name(state_name, argument.get("template"))
+                self.check_number(where, "offset_x of click", argument.get("offset_x", 0))
+            if name == "place_cards":
+                for key in ("offset", "drag"):
+                    if key in argument:
+                        self.check_pair(where, f"{key} of place_cards", argument[key])
+                self.check_number(where, "delay of place_cards", argument.get("delay", 2))
+            actions.append((name, argument))
+        return actions
 
-def format_duration(seconds):
+    def searches(self):
+        """The (template, confidence, grayscale) searches for the current state."""
+        return self.states[self.state].searches
+
+    def all_searches(self):
+        """Every search any state runs, e.g. for benchmarking the whole mode."""
+        return list(dict.fromkeys(search for state in self.states.values() for search in state.searches))
+
+    def resume(self, state, since):
+        """Puts the machine back in a state saved by a checkpoint, without running its enter actions."""
+        self.state = state
+        self.state_since = since
+
+    def enter(self, target, current_time):
+        """Moves to target, returning its enter actions if it is a different state."""
+        changed = target != self.state
+        self.state = target
+        self.state_since = current_time
+        self.missing_since = {}
+        if not changed:
+            return []
+        self.next_repeat_time = 0
+        state = self.states[target]
+        if state.log:
+            log_event(state.log, event_type="state")
+        return [(name, argument, None) for name, argument in state.enter]
+
+    def step(self, detections, current_time):
+        """
+        Advances the machine by one tick of detections for the current state.
+        Returns the (action, argument, match) calls to run, in order.
+        """
+        state = self.states[self.state]
+        calls = []
+        for transition in state.transitions:
+            match = None
+            if transition.kind == "found":
+                match = detections.get(transition.template)
+                if match is None or current_time - self.state_since < transition.after:
+                    continue
+            elif transition.kind == "missing":
+                if detections.get(transition.template) is not None:
+                    self.missing_since.pop(transition.template, None)
+                    continue
+                if transition.template not in self.missing_since:
+                    self.missing_since[transition.template] = current_time
+                    if transition.waiting_log:
+                        log_event(transition.waiting_log)
+                if current_time - self.missing_since[transition.template] < transition.duration:
+                    continue
+            elif any(detections.get(template.name) is not None for template, _, _ in state.searches):
+                continue
+            if transition.log:
+                log_event(transition.log)
+            calls += [(name, argument, match) for name, argument in transition.actions]
+            calls += self.enter(transition.target, current_time)
+            break
+
+        repeat = self.states[self.state].repeat
+        if repeat and current_time >= self.next_repeat_time:
+            template_name, every, actions = repeat
+            match = detections.get(template_name)
+            if match is not None:
+                calls += [(name, argument, match) for name, argument in actions]
+                self.next_repeat_time = current_time + every
+        return calls
+
+def load_game_modes(templates, path=MODES_FILE, pause_on_error=True):
     """
-    Formats a duration in seconds into a string of days, hours, minutes, and seconds.
+    Reads the game modes and checks that every one of them compiles.
+    Exits with a report if the modes file is unreadable or a mode is invalid.
     """
-    days = int(seconds // 86400)
-    hours = int((seconds % 86400) // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = int(seconds % 60)
-    
-    parts = []
-    if days > 0:
-        parts.append(f"{days} day{'s' if days > 1 else ''}")
-    if hours > 0:
-        parts.append(f"{hours} hour{'s' if hours > 1 else ''}")
-    if minutes > 0:
-        parts.append(f"{minutes} minute{'s' if minutes > 1 else ''}")
-    parts.append(f"{seconds} second{'s' if seconds > 1 or seconds == 0 else ''}")
-
-    return ", ".join(parts)
+    errors = []
+    try:
+        modes = read_game_modes(path)
+    except Exception as e:
+        modes = {}
+        errors.append(f"  - ERROR: Could not read {path}: {e}")
+    for name in modes:
+        try:
+            StateMachine(name, modes, templates)
+        except ValueError as e:
+            errors.append(f"  - ERROR: {e}")
+        except Exception as e:
+            errors.append(f"  - ERROR: Mode '{name}' is malformed: {e}")
+    if errors:
+        print("\nGame Mode Errors:")
+        for error in errors:
+            print(error)
+        if pause_on_error:
+            input("Press Enter to exit...")
+        sys.exit(1)
+    return modes
 
 # --- Main Script Logic ---
 
-def monitor_game_status(game_mode, image_paths):
+def monitor_game_status(game_mode, templates, observer=None, stop_event=None):
     """
     The main monitoring loop for the game bot.
+    observer, if given, is called with (frame capture time, game state) after
+    every processed tick. The loop runs until stop_event is set, or forever.
     """
     log_event(f"The King's Hand v1.0 initialized and ready. Selected mode: {game_mode}")
     print("-" * 50)
     log_event("Please ensure the game window is in focus.")
-    log_event("All events will be logged to bot_log.txt")
+    log_event(f"All events will be logged to {log_writer.path}")
 
-    game_state = "unknown"
+    machine = StateMachine(game_mode, game_modes, templates)
     start_time_finding_game = time.time()
     start_time_in_battle = None
     start_time_total = time.time()
+    stats = SessionStats(start_time_total)
     last_log_time = time.time()
     last_stats_log_time = time.time()
-    games_completed = 0
-    total_cards_placed = 0
-    game_find_times = []
-    battle_durations = []
-    unknown_state_start_time = None
-    last_battle_button_click_time = 0  # Track when we last clicked the battle button
-    last_in_battle_detection_time = 0  # Track when we last detected being in battle
-    battle_detection_lost_time = None  # Track when we first lost battle detection
-    
-    # Deques to store recent game data for calculating rolling averages
-    games_completed_last_week = deque(maxlen=7)
-    games_completed_last_month = deque(maxlen=30)
+    last_checkpoint_time = time.time()
 
+    session = current_session()
 
-    while True:
+    # Carry on from the last checkpoint: statistics always, and the game state and
+    # window position too if the checkpoint is recent enough to still be true
+    saved = checkpointer.resume(session.name) if checkpointer is not None else None
+    if saved is not None:
+        current_time = time.time()
+        stats.restore(saved["stats"], current_time)
+        age = current_time - saved["time"]
+        resumed_state = saved.get("mode") == game_mode and saved.get("state") in machine.states and age <= CHECKPOINT_MAX_AGE
+        if resumed_state:
+            machine.resume(saved["state"], saved["state_since"])
+            start_time_finding_game = saved["start_time_finding_game"]
+            start_time_in_battle = saved["start_time_in_battle"]
+            if saved.get("window") and session.window_locator.rect is None:
+                session.window_locator.resume(*saved["window"], current_time)
+        session.region_cache.restore(saved.get("regions", {}))
+        log_event(f"Resumed from a checkpoint saved {format_duration(age)} ago: {stats.games_completed} game(s) so far"
+                  + (f", state '{machine.state}'." if resumed_state else "; finding the game state afresh."),
+                  event_type="state", games_completed=stats.games_completed)
+
+    def progress(current_time):
+        """This session's checkpoint: everything needed to carry on after a restart."""
+        window_locator = session.window_locator
+        return {
+            "time": current_time,
+            "mode": game_mode,
+            "state": machine.state,
+            "state_since": machine.state_since,
+            "start_time_finding_game": start_time_finding_game,
+            "start_time_in_battle": start_time_in_battle,
+            "window": [list(window_locator.rect), window_locator.scale] if window_locator.rect else None,
+            "regions": session.region_cache.checkpoint(),
+            "stats": stats.checkpoint(current_time)
+        }
+
+    def place_card(x, y):
+        if session.actions.submit(lambda: jitter_click(x, y), "place card"):
+            stats.record_cards()
+
+    def result_screen_clicked(clicked):
+        nonlocal start_time_finding_game
+        start_time_finding_game = time.time()
+
+    def battle_button_clicked(clicked):
+        nonlocal start_time_finding_game
+        if not clicked:
+            log_event("Failed to click battle button. Re-entering loop to try again.")
+        start_time_finding_game = time.time()
+
+    def click_result_button(template, confidence, grayscale, offset_x=0):
+        click_with_retry(template, confidence=confidence, grayscale=grayscale, offset_x=offset_x)
+        wait_for_transition(2)  # Give time for screen transition
+
+    # The actions a mode definition can use, called with (argument, match) where
+    # match is the template found by the transition, if any
+    def battle_started(argument, match):
+        nonlocal start_time_in_battle
+        elapsed_finding_game = time.time() - start_time_finding_game
+        log_event(f"Status: Detected you are in a battle. Found a game in {elapsed_finding_game:.2f} seconds.", event_type="state", game_find_time=elapsed_finding_game)
+        stats.record_find_time(elapsed_finding_game)
+        start_time_in_battle = time.time()
+
+    def battle_finished(argument, match):
+        nonlocal start_time_in_battle, last_checkpoint_time
+        if start_time_in_battle is None:
+            return  # No battle since the last one was counted
+        elapsed_in_battle = time.time() - start_time_in_battle
+        log_event(f"Status: Battle finished. The battle lasted {elapsed_in_battle:.2f} seconds.", event_type="state", battle_duration=elapsed_in_battle)
+        stats.record_game(elapsed_in_battle)
+        log_event(f"The bot has finished {stats.games_completed} game(s) so far.")
+        start_time_in_battle = None
+        last_checkpoint_time = 0  # Save the finished game at the next tick
+
+    def place_cards(argument, match):
+        # The second click and the next pair are scheduled rather than slept for,
+        # so detection keeps running in between.
+        log_event("Selecting and placing cards...")
+        card_offset_x, card_offset_y = session.window_locator.scale_offset(*argument.get("offset", (300, -100)))
+        drag_x, drag_y = session.window_locator.scale_offset(*argument.get("drag", (0, -300)))
+        click1_x = match.x + card_offset_x
+        click1_y = match.y + card_offset_y
+        place_card(click1_x, click1_y)
+        session.scheduler.schedule(argument.get("delay", 2), lambda x=click1_x + drag_x, y=click1_y + drag_y: place_card(x, y), "place card")
+
+    def click(argument, match):
+        template, confidence, grayscale = machine.search_settings[argument["template"]]
+        offset_x = argument.get("offset_x", 0)
+        session.actions.submit(lambda: click_result_button(template, confidence, grayscale, offset_x), f"click {template.name}", result_screen_clicked)
+
+    def click_battle(argument, match):
+        session.actions.submit(lambda: click_battle_button(templates, machine.battle_second_click), "click Battle button", battle_button_clicked)
+
+    action_handlers = {
+        "battle_started": battle_started,
+        "battle_finished": battle_finished,
+        "place_cards": place_cards,
+        "click": click,
+        "click_battle_button": click_battle
+    }
+
+    def session_metrics():
+        snapshot = stats.snapshot(time.time())
+        labels = {"session": session.name} if session.name else {}
+
+        def sample(value, suffix="", **extra_labels):
+            return (suffix, dict(labels, **extra_labels) or None, value)
+
+        families = [
+            ("tkh_games_completed_total", "counter", "Games finished this session.", [sample(snapshot["games_completed"])]),
+            ("tkh_cards_placed_total", "counter", "Cards placed this session.", [sample(snapshot["cards_placed"])]),
+            ("tkh_games_recent", "gauge", "Games finished in each rolling window.", [
+                sample(snapshot["games_last_hour"], window="1h"),
+                sample(snapshot["games_last_24_hours"], window="24h"),
+                sample(snapshot["games_last_7_days"], window="7d")
+            ])
+        ]
+        for name, key, help_text in [("tkh_game_find_seconds", "game_find_time", "Time from the menu to a found game."),
+                                     ("tkh_battle_duration_seconds", "battle_duration", "Length of a battle.")]:
+            summary = snapshot[key]
+            families.append((name, "summary", help_text, [
+                sample(summary["p50"], quantile="0.5"),
+                sample(summary["p95"], quantile="0.95"),
+                sample(summary["mean"] * summary["count"], "_sum"),
+                sample(summary["count"], "_count")
+            ]))
+        families += [
+            ("tkh_ticks_skipped_total", "counter", "Ticks skipped because the screen was unchanged.", [sample(session.change_gate.skipped_ticks)]),
+            ("tkh_frames_dropped_total", "counter", "Frames dropped because detection was busy.", [sample(pipeline.frames.dropped)]),
+            ("tkh_region_hit_ratio", "gauge", "Share of lookups found in their learned search region.", [sample(session.region_cache.hit_rate())])
+        ]
+        return families
+
+    # Capture and detection run on background threads; this loop consumes their
+    # detections and hands clicks to the action executor
+    pipeline = DetectionPipeline(machine.searches(), session.frame_feed)
+    pipeline.start()
+    session.actions.start()
+    if metrics is not None:
+        metrics.collectors.append(session_metrics)
+
+    while stop_event is None or not stop_event.is_set():
+        event = pipeline.next_event(session.scheduler.time_until_next(LOOP_INTERVAL))
         current_time = time.time()
+        session.scheduler.run_due(current_time)
+
+        if checkpointer is not None and current_time - last_checkpoint_time >= CHECKPOINT_INTERVAL:
+            checkpointer.update(session.name, progress(current_time))
+            last_checkpoint_time = current_time
         
         # Log general bot runtime every 10 seconds
         if current_time - last_log_time >= 10:
             total_runtime = current_time - start_time_total
             formatted_runtime = format_duration(total_runtime)
-            log_event(f"Bot has been running for: {formatted_runtime}.")
+            log_event(f"Bot has been running for: {formatted_runtime}.", event_type="runtime", runtime_seconds=total_runtime)
             last_log_time = current_time
 
         # Print stats every 60 seconds
         if current_time - last_stats_log_time >= 40:
-            total_runtime_seconds = current_time - start_time_total
-            avg_find_time = sum(game_find_times) / len(game_find_times) if game_find_times else 0
-            avg_battle_time = sum(battle_durations) / len(battle_durations) if battle_durations else 0
-            avg_cards_per_game = total_cards_placed / games_completed if games_completed > 0 else 0
-            
-            # Calculate average games per hour and per day
-            avg_games_per_hour = (games_completed / total_runtime_seconds) * 3600 if total_runtime_seconds > 0 else 0
-            avg_games_per_24_hours = (games_completed / total_runtime_seconds) * 86400 if total_runtime_seconds > 0 else 0
-            
-            # Calculate weekly and monthly averages
-            avg_games_per_week = (games_completed / total_runtime_seconds) * (86400 * 7) if total_runtime_seconds > 0 else 0
-            avg_games_per_month = (games_completed / total_runtime_seconds) * (86400 * 30) if total_runtime_seconds > 0 else 0
+            snapshot = stats.snapshot(current_time)
+            find_time = snapshot["game_find_time"]
+            battle_duration = snapshot["battle_duration"]
             
-            log_event("-" * 50)
-            log_event("Current Automation Stats")
-            log_event("-" * 50)
-            log_event(f"  - Games Completed: {games_completed}")
-            log_event(f"  - Avg. Game Find Time: {avg_find_time:.2f} seconds")
-            log_event(f"  - Avg. Battle Duration: {avg_battle_time:.2f} seconds")
-            log_event(f"  - Avg. Cards per Game: {avg_cards_per_game:.2f}")
-            log_event(f"  - Avg. Games per Hour: {avg_games_per_hour:.2f}")
-            log_event(f"  - Avg. Games per 24 Hours: {avg_games_per_24_hours:.2f}")
-            log_event(f"  - Avg. Games per Week: {avg_games_per_week:.2f}")
-            log_event(f"  - Avg. Games per Month: {avg_games_per_month:.2f}")
-            log_event("-" * 50)
+            log_event("-" * 50, event_type="stats")
+            log_event("Current Automation Stats", event_type="stats")
+            log_event("-" * 50, event_type="stats")
+            log_event(f"  - Games Completed: {snapshot['games_completed']}", event_type="stats")
+            log_event(f"  - Avg. Game Find Time: {find_time['mean']:.2f} seconds (median {find_time['p50']:.2f}, 95th percentile {find_time['p95']:.2f})", event_type="stats")
+            log_event(f"  - Avg. Battle Duration: {battle_duration['mean']:.2f} seconds (median {battle_duration['p50']:.2f}, 95th percentile {battle_duration['p95']:.2f})", event_type="stats")
+            log_event(f"  - Avg. Cards per Game: {snapshot['cards_per_game']:.2f}", event_type="stats")
+            log_event(f"  - Avg. Games per Hour: {snapshot['games_per_hour']:.2f}", event_type="stats")
+            log_event(f"  - Games in the Last Hour: {snapshot['games_last_hour']}", event_type="stats")
+            log_event(f"  - Games in the Last 24 Hours: {snapshot['games_last_24_hours']}", event_type="stats")
+            log_event(f"  - Games in the Last 7 Days: {snapshot['games_last_7_days']}", event_type="stats")
+            log_event(f"  - Avg. Tick Time (Capture to Detections): {session.frame_provider.average_tick_time() * 1000:.1f} ms", event_type="stats")
+            log_event(f"  - Avg. Screenshot Time: {session.frame_provider.average_capture_time() * 1000:.1f} ms", event_type="stats")
+            log_event(f"  - Screenshots per Tick: {session.frame_provider.captures_per_tick():.2f}", event_type="stats")
+            log_event(f"  - Search Region Hit Rate: {session.region_cache.hit_rate() * 100:.1f}%", event_type="stats")
+            log_event(f"  - Ticks Skipped (Screen Unchanged): {session.change_gate.skipped_ticks} ({session.change_gate.skip_rate() * 100:.1f}%)", event_type="stats")
+            log_event(f"  - Frames Dropped (Detection Busy): {pipeline.frames.dropped}", event_type="stats")
+            log_event("-" * 50, event_type="stats")
             last_stats_log_time = current_time
 
-        # Reset unknown state timer on state change
-        if game_state != "unknown":
-            unknown_state_start_time = None
-        
-        # Check for in-battle marker with stability system
-        in_battle_location = find_image_on_screen(image_paths['in_battle_image'], confidence=0.9)
-        if in_battle_location:
-            # Update the last detection time
-            last_in_battle_detection_time = current_time
-            battle_detection_lost_time = None  # Reset the lost detection timer
-            
-            if game_state != "in_battle":
-                elapsed_finding_game = time.time() - start_time_finding_game
-                log_event(f"Status: Detected you are in a battle. Found a game in {elapsed_finding_game:.2f} seconds.")
-                game_find_times.append(elapsed_finding_game)
-                game_state = "in_battle"
-                start_time_in_battle = time.time()
-            
-            # Perform clicks while in battle
-            log_event("Selecting and placing cards...")
-            click1_x = in_battle_location[0] + 300
-            click1_y = in_battle_location[1] - 100
-            jitter_click(click1_x, click1_y)
-            total_cards_placed += 1
-            time.sleep(2)
-            
-            click2_x = click1_x
-            click2_y = click1_y - 300
-            jitter_click(click2_x, click2_y)
-            total_cards_placed += 1
-            time.sleep(1)
-        
-        # Handle case where in-battle marker is not detected
-        elif game_state == "in_battle":
-            # We were in battle but don't detect it now - start the stability timer
-            if battle_detection_lost_time is None:
-                battle_detection_lost_time = current_time
-                log_event("Temporarily lost in-battle detection. Waiting for stability...")
-            elif (current_time - battle_detection_lost_time) >= 5:
-                # We've lost detection for 5+ seconds, consider battle actually ended
-                log_event("In-battle detection lost for 5+ seconds. Battle likely ended.")
-                game_state = "battle_ended_waiting_for_results"
-                battle_detection_lost_time = None
-            # If less than 5 seconds, continue as if still in battle but don't perform actions
-
-        # Check for 2v2 end button (battle complete for 2v2)
-        elif game_mode == "2v2" and find_image_on_screen(image_paths['two_v_two_end_image'], confidence=0.8, grayscale=True):
-            if game_state not in ["battle_complete_2v2", "battle_ended_waiting_for_results"]:
-                elapsed_in_battle = time.time() - start_time_in_battle if start_time_in_battle else 0
-                log_event(f"Status: Battle finished. The battle lasted {elapsed_in_battle:.2f} seconds.")
-                battle_durations.append(elapsed_in_battle)
-                games_completed += 1
-                log_event(f"The bot has finished {games_completed} game(s) so far.")
-                game_state = "battle_complete_2v2"
-                
-                log_event("Clicking 2v2 end button.")
-                click_with_retry(image_paths['two_v_two_end_image'], confidence=0.8, grayscale=True)
-                time.sleep(2)  # Give time for screen transition
-                game_state = "returning_to_menu"  # Reset state to allow Battle button detection
-                start_time_finding_game = time.time()
-
-        # Check for play again button (1v1 Trophy Road)
-        elif game_mode == "1v1_trophy_road" and find_image_on_screen(image_paths['play_again_image'], confidence=0.8, grayscale=False):
-            if game_state not in ["battle_complete_1v1_trophy_road", "battle_ended_waiting_for_results"]:
-                elapsed_in_battle = time.time() - start_time_in_battle if start_time_in_battle else 0
-                log_event(f"Status: Battle finished. The battle lasted {elapsed_in_battle:.2f} seconds.")
-                battle_durations.append(elapsed_in_battle)
-                games_completed += 1
-                log_event(f"The bot has finished {games_completed} game(s) so far.")
-                game_state = "battle_complete_1v1_trophy_road"
-            
-            log_event("Clicking Play Again button.")
-            click_with_retry(image_paths['play_again_image'], confidence=0.8, grayscale=False)
-            time.sleep(2)  # Give time for screen transition
-            game_state = "returning_to_menu"  # Reset state to allow Battle button detection
-            start_time_finding_game = time.time()
-
-        # Check for OK button (battle complete - prioritize this over Battle button detection)
-        elif find_image_on_screen(image_paths['ok_button_image'], confidence=0.5, grayscale=True):
-            if game_state not in ["battle_complete_1v1", "battle_complete_1v1_trophy_road", "battle_ended_waiting_for_results"]:
-                elapsed_in_battle = time.time() - start_time_in_battle if start_time_in_battle else 0
-                log_event(f"Status: Battle finished. The battle lasted {elapsed_in_battle:.2f} seconds.")
-                battle_durations.append(elapsed_in_battle)
-                games_completed += 1
-                log_event(f"The bot has finished {games_completed} game(s) so far.")
-                game_state = "battle_complete_1v1"
-            
-            log_event("Clicking OK button to return to main menu.")
-            click_with_retry(image_paths['ok_button_image'], confidence=0.5, grayscale=True, offset_x=-30)
-            time.sleep(2)  # Give time for screen transition
-            game_state = "returning_to_menu"  # Reset state to allow Battle button detection
-            start_time_finding_game = time.time()
-
-        # Check for Battle button (main menu) - use higher confidence to avoid false positives
-        elif find_image_on_screen(image_paths['battle_button_image'], confidence=0.7):
-            # Only avoid clicking if we just completed a battle and haven't processed the post-battle screen yet
-            if game_state in ["battle_complete_1v1", "battle_complete_2v2", "battle_complete_1v1_trophy_road"]:
-                # We just completed a battle, wait for the proper post-battle screen
-                log_event("Battle button detected but ignoring since we just completed a battle. Waiting for proper post-battle screen...")
-                time.sleep(1)
-            # Also avoid clicking if we recently clicked the battle button (within 5 seconds)
-            elif (current_time - last_battle_button_click_time) < 5:
-                # We recently clicked the battle button, probably in a loading/transition state
-                pass  # Do nothing, don't log spam
-            # Also avoid if we're in unknown state (likely a transition screen)
-            elif game_state == "unknown" and unknown_state_start_time and (current_time - unknown_state_start_time) < 3:
-                # We're in an unknown state recently, probably a transition screen showing false battle button
-                pass  # Do nothing, don't log spam
-            else:
-                # Safe to click the battle button - ensure we're actually on main menu
-                if game_state != "not_in_battle":
-                    log_event("Status: Detected main menu. Initiating new game...")
-                    game_state = "not_in_battle"
-                    
-                    # Use the new retry function for the battle button
-                    if click_battle_button(image_paths, game_mode):
-                        last_battle_button_click_time = current_time  # Record successful click time
-                    else:
-                        log_event("Failed to click battle button. Re-entering loop to try again.")
-                    start_time_finding_game = time.time()
-
-        # If none of the known states are found, check for a fallback
+        # Wait for detections from a frame captured after the last click finished,
+        # matched with the current state's searches
+        if (event is None or session.actions.busy() or event.capture_time < session.actions.last_finished_time
+                or event.searches is not machine.searches()):
+            session.region_cache.save_if_due(current_time)
+            continue
+
+        for action, argument, match in machine.step(event.detections, current_time):
+            try:
+                action_handlers[action](argument, match)
+            except Exception as e:
+                log_event(f"ERROR: Action '{action}' failed: {e}", event_type="error")
+        pipeline.searches = machine.searches()
+
+        if observer:
+            observer(event.capture_time, machine.state)
+        if metrics is not None:
+            metrics.record_state(machine.state, current_time, session.name)
+
+        session.region_cache.save_if_due(time.time())
+
+    pipeline.stop()
+    if checkpointer is not None:
+        checkpointer.update(session.name, progress(time.time()))
+    if metrics is not None:
+        metrics.collectors.remove(session_metrics)
+        metrics.end_session(session.name)
+
+# --- Multi-Window Mode ---
+
+class SharedScreen:
+    """
+    The desktop screenshot shared by every session in multi-window mode, so the
+    desktop is captured once per tick however many game windows are on it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+        self.captures = 0
+        self.total_capture_time = 0.0
+
+    def capture(self, newer_than=0):
+        """
+        Returns a desktop screenshot started no earlier than newer_than, taking a
+        new one only if the last one is older. Only the runner's capture loop
+        captures; sessions wait for its screenshots instead.
+        """
+        with self.lock:
+            if self.frame is None or self.frame.capture_time < newer_than:
+                # Stamped with the time the capture started, as the screen may change while it runs
+                start_time = time.time()
+                capture_start = time.perf_counter()
+                self.frame = Frame(screen_source(), capture_time=start_time)
+                capture_time = time.perf_counter() - capture_start
+                self.total_capture_time += capture_time
+                self.captures += 1
+                if metrics is not None:
+                    metrics.screenshot_seconds.observe(capture_time)
+            return self.frame
+
+    def average_capture_time(self):
+        return self.total_capture_time / self.captures if self.captures else 0
+
+class SessionFrameProvider(FrameProvider):
+    """A FrameProvider that serves one window's slice of the SharedScreen instead of capturing itself."""
+
+    def __init__(self, screen, window_locator):
+        super().__init__()
+        self.screen = screen
+        self.window_locator = window_locator
+        self.new_frame = threading.Condition()
+
+    def publish(self, frame):
+        """Called by the runner's capture loop with this window's slice of every desktop screenshot."""
+        with self.new_frame:
+            self.frame = frame
+            self.new_frame.notify_all()
+
+    def refresh(self):
+        """
+        Waits for the runner's next desktop screenshot started after this call,
+        rather than capturing, so waiting sessions add no captures of their own.
+        Falls back to the newest frame after SHARED_FRAME_TIMEOUT, e.g. while the window is lost.
+        """
+        requested_time = time.time()
+        with self.new_frame:
+            self.new_frame.wait_for(lambda: self.frame is not None and self.frame.capture_time >= requested_time, SHARED_FRAME_TIMEOUT)
+            return self.frame
+
+    def average_capture_time(self):
+        return self.screen.average_capture_time()
+
+    def captures_per_tick(self):
+        return self.screen.captures / self.ticks if self.ticks else 0
+
+class InputArbiter:
+    """
+    The one input queue every session clicks through. Clicks are sent one at a
+    time on the arbiter's thread in the order they were asked for, and each
+    caller waits until its click has been sent. A session therefore never has
+    more than one click queued, so no window can starve the others.
+    """
+
+    def __init__(self):
+        self.requests = queue.Queue()
+        self.thread = None
+        self.clicks = 0
+        self.total_wait_time = 0.0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="input", daemon=True)
+            self.thread.start()
+
+    def click(self, x, y):
+        done = threading.Event()
+        self.requests.put((x, y, done, time.perf_counter()))
+        done.wait()
+
+    def run(self):
+        while True:
+            x, y, done, queued_time = self.requests.get()
+            try:
+                click_sink(x, y)
+            except Exception as e:
+                log_event(f"ERROR: Click at ({x}, {y}) failed: {e}", event_type="error")
+            finally:
+                self.clicks += 1
+                self.total_wait_time += time.perf_counter() - queued_time
+                done.set()
+
+    def average_wait_time(self):
+        return self.total_wait_time / self.clicks if self.clicks else 0
+
+class MultiWindowRunner:
+    """
+    Drives several game windows from one process. One capture loop takes a
+    single desktop screenshot per tick and hands each session its window's
+    slice; every session runs its own state machine on its own thread, and all
+    clicks go through one InputArbiter.
+    """
+
+    def __init__(self, game_mode, templates, max_windows=MAX_GAME_WINDOWS):
+        self.game_mode = game_mode
+        self.templates = templates
+        self.max_windows = max_windows
+        self.screen = SharedScreen()
+        self.input = InputArbiter()
+        self.locator = WindowLocator()
+        self.locator.template = templates['game_window_image']
+        self.sessions = []
+        self.lost = set()  # Names of sessions whose window was not found at the last check
+        self.threads = []
+        self.stop_event = None
+        self.last_check_time = 0
+
+    def add_session(self, rect, scale):
+        name = f"window {len(self.sessions) + 1}"
+        locator = WindowLocator()
+        locator.rect = rect
+        locator.scale = scale
+        session = GameSession(name, locator, SessionFrameProvider(self.screen, locator), RegionCache(path=None),
+                              ChangeGate(), Scheduler(), ActionExecutor(), self.input.click, LatestQueue())
+        self.sessions.append(session)
+        log_event(f"Game window found at {rect} (click scale {scale:.2f}). Starting session '{name}'.")
+        thread = threading.Thread(target=self.run_session, args=(session,), name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def run_session(self, session):
+        session_context.session = session
+        monitor_game_status(self.game_mode, self.templates, stop_event=self.stop_event)
+
+    def update_windows(self, screen):
+        """
+        Matches the windows found on screen to the sessions by position, so a
+        moved window keeps its session, and starts sessions for new windows.
+        """
+        unmatched = list(self.sessions)
+        for rect, scale in self.locator.locate_all(screen, self.max_windows):
+            if not unmatched:
+                if len(self.sessions) < self.max_windows:
+                    self.add_session(rect, scale)
+                continue
+            session = min(unmatched, key=lambda s: abs(s.window_locator.rect[0] - rect[0]) + abs(s.window_locator.rect[1] - rect[1]))
+            unmatched.remove(session)
+            if session.window_locator.rect != rect:
+                log_event(f"Session '{session.name}' window moved to {rect}.")
+            session.window_locator.rect = rect
+            session.window_locator.scale = scale
+            if session.name in self.lost:
+                log_event(f"Session '{session.name}' window found again.")
+                self.lost.discard(session.name)
+        for session in unmatched:
+            if session.name not in self.lost:
+                log_event(f"Session '{session.name}' window not found. Pausing it until it is found again.")
+                self.lost.add(session.name)
+
+    def run(self, stop_event=None):
+        """Runs the capture loop until stop_event is set, or forever."""
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.input.start()
+        log_event(f"Multi-window mode: looking for up to {self.max_windows} game windows.")
+        last_stats_log_time = time.time()
+        while not self.stop_event.is_set():
+            capture_start = time.time()
+            try:
+                screen = self.screen.capture(newer_than=capture_start)
+                interval = WINDOW_RECHECK_INTERVAL if self.sessions and not self.lost else WINDOW_SEARCH_RETRY_INTERVAL
+                if capture_start - self.last_check_time >= interval:
+                    self.last_check_time = capture_start
+                    self.update_windows(screen)
+                for session in self.sessions:
+                    if session.name not in self.lost:
+                        frame = session.window_locator.crop(screen)
+                        session.frame_provider.publish(frame)
+                        session.frame_feed.put(frame)
+            except Exception as e:
+                log_event(f"ERROR: An error occurred while capturing the screen: {e}", event_type="error")
+
+            if capture_start - last_stats_log_time >= 40:
+                log_event(f"Desktop screenshots: {self.screen.captures} for {len(self.sessions) - len(self.lost)} active session(s), "
+                          f"avg. {self.screen.average_capture_time() * 1000:.1f} ms. Clicks sent: {self.input.clicks}, "
+                          f"avg. input queue wait {self.input.average_wait_time() * 1000:.1f} ms.", event_type="stats")
+                last_stats_log_time = capture_start
+
+            remaining = CAPTURE_INTERVAL - (time.time() - capture_start)
+            if remaining > 0:
+                self.stop_event.wait(remaining)
+        for thread in self.threads:
+            thread.join()
+
+# --- Replay and Benchmarking ---
+
+REPLAY_MANIFEST = "frames.jsonl"
+RECORD_QUEUE_SIZE = 32  # Frames waiting to be written to disk; more are dropped rather than slowing capture
+TRANSITION_TOLERANCE = 2.0  # Seconds a replayed state change may be off from the recorded one and still match
+
+class SessionRecorder:
+    """
+    Records a live session in the replay format: every captured frame as a PNG
+    plus a frames.jsonl manifest of session, frame, state and click events.
+    Wraps the live screenshot source and click sink.
+    """
+
+    def __init__(self, directory, game_mode, source, sink):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.source = source
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.manifest = open(os.path.join(directory, REPLAY_MANIFEST), "w")
+        self.frames = queue.Queue(maxsize=RECORD_QUEUE_SIZE)
+        self.frame_count = 0
+        self.dropped_frames = 0
+        self.closed = False
+        self.last_state = None
+        self.write_event({"type": "session", "time": time.time(), "mode": game_mode})
+        threading.Thread(target=self.write_frames, name="recorder", daemon=True).start()
+
+    def write_event(self, event):
+        with self.lock:
+            if self.manifest.closed:
+                return  # A late click after the recording ended
+            self.manifest.write(json.dumps(event) + "\n")
+            self.manifest.flush()
+
+    def capture(self):
+        """Screenshot source: captures as usual and queues the frame to be saved."""
+        rgb = self.source()
+        if self.closed:
+            return rgb
+        try:
+            self.frames.put_nowait((time.time(), rgb))
+        except queue.Full:
+            self.dropped_frames += 1
+        return rgb
+
+    def click(self, x, y):
+        """Click sink: clicks as usual and records the click."""
+        self.sink(x, y)
+        self.write_event({"type": "click", "time": time.time(), "x": x, "y": y})
+
+    def observe(self, capture_time, game_state):
+        """monitor_game_status observer: records every state change."""
+        if game_state != self.last_state:
+            self.last_state = game_state
+            self.write_event({"type": "state", "time": capture_time, "state": game_state})
+
+    def write_frames(self):
+        while True:
+            capture_time, rgb = self.frames.get()
+            file_name = f"frame_{self.frame_count:07d}.png"
+            self.frame_count += 1
+            cv2.imwrite(os.path.join(self.directory, file_name), cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+            self.write_event({"type": "frame", "time": capture_time, "file": file_name})
+            self.frames.task_done()
+
+    def close(self):
+        """
+        Writes the frames still queued, then ends the manifest with the number of
+        frames saved and dropped, and reports any drops: a replay shows the last
+        saved frame in their place.
+        """
+        self.closed = True
+        self.frames.join()
+        self.write_event({"type": "end", "time": time.time(), "frames": self.frame_count, "dropped_frames": self.dropped_frames})
+        self.manifest.close()
+        message = f"Recording saved {self.frame_count} frame(s) to {self.directory}."
+        if self.dropped_frames:
+            message += f" {self.dropped_frames} frame(s) were dropped because saving fell behind; the replay will have gaps there."
+        log_event(message, event_type="error" if self.dropped_frames else "info", frames=self.frame_count, dropped_frames=self.dropped_frames)
+
+class ReplaySource:
+    """
+    Plays a recorded directory, or a video file, back in place of the screen.
+    Frames are served on the recording's own timeline, sped up by speed.
+    A video may have a sidecar <name>.jsonl of state events, timed in seconds from its start.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.mode = None
+        self.frame_times = []
+        self.frame_files = []
+        self.state_times = []
+        self.states = []
+        self.video = None
+        self.video_position = 0
+        self.cached_index = None
+        self.cached_frame = None
+        self.video_buffer = None
+        self.wall_start = None
+        self.finished = threading.Event()
+        if os.path.isdir(path):
+            self.load_manifest(os.path.join(path, REPLAY_MANIFEST))
         else:
-            if game_state != "unknown":
-                log_event("Status: Unknown or loading screen.")
-                game_state = "unknown"
-                unknown_state_start_time = time.time()
-            
-            # Reset battle completion states after some time to allow normal menu detection
-            elif game_state in ["battle_complete_1v1", "battle_complete_2v2", "battle_complete_1v1_trophy_road"] and unknown_state_start_time and (current_time - unknown_state_start_time) > 5:
-                log_event("Resetting battle completion state to allow normal menu detection.")
-                game_state = "unknown"
-
-            # Fallback for 1v1 Trophy Road mode if "playagain.png" is not found
-            if game_mode == "1v1_trophy_road" and unknown_state_start_time and (current_time - unknown_state_start_time) > 10:
-                ok_location = find_image_on_screen(image_paths['ok_button_image'], confidence=0.5, grayscale=True)
-                if ok_location:
-                    log_event("Status: In unknown state for too long. Found OK button as a fallback.")
-                    
-                    elapsed_in_battle = time.time() - start_time_in_battle if start_time_in_battle else 0
-                    log_event(f"Status: Battle finished. The battle lasted {elapsed_in_battle:.2f} seconds.")
-                    battle_durations.append(elapsed_in_battle)
-                    games_completed += 1
-                    log_event(f"The bot has finished {games_completed} game(s) so far.")
-                    game_state = "battle_complete_1v1"
-
-                    log_event("Clicking OK button to return to main menu.")
-                    click_with_retry(image_paths['ok_button_image'], confidence=0.5, grayscale=True, offset_x=-30)
-                    time.sleep(2)  # Give time for screen transition
-                    game_state = "returning_to_menu"  # Reset state to allow Battle button detection
-                    start_time_finding_game = time.time()
-                    unknown_state_start_time = None # Reset the timer
-
-        time.sleep(0.1)
+            self.load_video(path)
+            labels_path = os.path.splitext(path)[0] + ".jsonl"
+            if os.path.exists(labels_path):
+                self.load_manifest(labels_path)
+        if not self.frame_times:
+            raise ValueError(f"No frames found in {path}")
 
-# --- Entry Point ---
-if __name__ == "__main__":
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Updated image paths to point to the 'assets' folder
-    image_paths = {
-        'battle_button_image': os.path.join(script_dir, 'assets', 'battle_button.png'),
-        'ok_button_image': os.path.join(script_dir, 'assets', 'ok.png'),
-        'play_again_image': os.path.join(script_dir, 'assets', 'playagain.png'),
-        'two_v_two_end_image': os.path.join(script_dir, 'assets', '2v2end.png'),
-        'in_battle_image': os.path.join(script_dir, 'assets', 'inbattle.png')
-    }
+    def __len__(self):
+        return len(self.frame_times)
 
-    os.system('cls' if os.name == 'nt' else 'clear')
+    def load_manifest(self, manifest_path):
+        with open(manifest_path, "r") as manifest:
+            for line in manifest:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event["type"] == "session":
+                    self.mode = event.get("mode")
+                elif event["type"] == "frame" and self.video is None:
+                    self.frame_times.append(event["time"])
+                    self.frame_files.append(event["file"])
+                elif event["type"] == "state":
+                    self.state_times.append(event["time"])
+                    self.states.append(event["state"])
+
+    def load_video(self, path):
+        self.video = cv2.VideoCapture(path)
+        if not self.video.isOpened():
+            raise ValueError(f"Could not open video {path}")
+        fps = self.video.get(cv2.CAP_PROP_FPS) or 10
+        frame_count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.frame_times = [index / fps for index in range(frame_count)]
+
+    def frame(self, index):
+        """Decodes one frame into an RGB array, returning the same one if it is asked for again."""
+        if index == self.cached_index:
+            return self.cached_frame
+        if self.video is not None:
+            if index < self.video_position:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+                self.video_position = index
+            while self.video_position < index:
+                self.video.grab()
+                self.video_position += 1
+            decoded, bgr = self.video.read(self.video_buffer)
+            self.video_buffer = bgr if decoded else None
+            self.video_position += 1
+        else:
+            bgr = cv2.imread(os.path.join(self.path, self.frame_files[index]), cv2.IMREAD_COLOR)
+            decoded = bgr is not None
+        if not decoded:
+            raise ValueError(f"Could not decode replay frame {index} of {self.path}")
+        self.cached_index = index
+        self.cached_frame = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        return self.cached_frame
+
+    def recording_time(self, wall_time):
+        """Converts a wall-clock time during playback to a time on the recording's timeline."""
+        return self.frame_times[0] + (wall_time - self.wall_start) * self.speed
+
+    def capture(self):
+        """Screenshot source: returns the frame due at this point of the playback."""
+        if self.wall_start is None:
+            self.wall_start = time.time()
+        playback_time = self.recording_time(time.time())
+        if playback_time > self.frame_times[-1]:
+            self.finished.set()
+        index = max(0, bisect.bisect_right(self.frame_times, playback_time) - 1)
+        return self.frame(index)
+
+    def state_at(self, recording_time):
+        """Returns the recorded state at a point on the recording's timeline, or None."""
+        index = bisect.bisect_right(self.state_times, recording_time) - 1
+        return self.states[index] if index >= 0 else None
+
+class ClickRecorder:
+    """Click sink for replays: records clicks instead of sending them."""
+
+    def __init__(self):
+        self.clicks = []
+
+    def __call__(self, x, y):
+        self.clicks.append((time.time(), x, y))
+
+def reset_detection_state(templates):
+    """Gives a replay fresh capture, search-region, change-detection and action state."""
+    global frame_provider, region_cache, change_gate, scheduler, actions, window_locator
+    frame_provider = FrameProvider()
+    region_cache = RegionCache(path=None)
+    change_gate = ChangeGate()
+    scheduler = Scheduler()
+    actions = ActionExecutor()
+    window_locator = WindowLocator()
+    window_locator.template = templates['game_window_image']
+
+def run_replay(path, game_mode, templates, speed=1.0):
+    """
+    Runs the bot on a recording instead of the screen, recording its clicks.
+    Returns (source, observed (recording time, state) pairs, clicks).
+    """
+    global screen_source, click_sink
+    source = ReplaySource(path, speed)
+    clicks = ClickRecorder()
+    screen_source = source.capture
+    click_sink = clicks
+    reset_detection_state(templates)
+    observed = []
+    monitor_game_status(
+        game_mode,
+        templates,
+        observer=lambda capture_time, game_state: observed.append((source.recording_time(capture_time), game_state)),
+        stop_event=source.finished
+    )
+    return source, observed, clicks.clicks
+
+def state_accuracy(source, observed):
+    """
+    Compares replayed states with the recorded ones. Returns (share of ticks in
+    the recorded state, recorded transitions reproduced, recorded transitions),
+    or None if the recording has no states.
+    """
+    if not source.states:
+        return None
+    agreeing_ticks = sum(1 for recording_time, game_state in observed if source.state_at(recording_time) == game_state)
+    tick_accuracy = agreeing_ticks / len(observed) if observed else 0
+    replayed_transitions = [
+        (recording_time, game_state)
+        for index, (recording_time, game_state) in enumerate(observed)
+        if index == 0 or observed[index - 1][1] != game_state
+    ]
+    matched = 0
+    for recorded_time, recorded_state in zip(source.state_times, source.states):
+        if any(game_state == recorded_state and abs(recording_time - recorded_time) <= TRANSITION_TOLERANCE
+               for recording_time, game_state in replayed_transitions):
+            matched += 1
+    return tick_accuracy, matched, len(source.states)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def benchmark_detection(source, searches):
+    """
+    Matches every recorded frame as fast as possible.
+    Returns (frames per second, {template name: sorted latencies in seconds}).
+    """
+    global region_cache, match_timer
+    region_cache = RegionCache(path=None)
+    latencies = {template.name: [] for template, _, _ in searches}
+    previous_timer = match_timer
+    match_timer = lambda name, seconds: latencies[name].append(seconds)
+    matching_time = 0.0
+    try:
+        for index in range(len(source)):
+            frame = Frame(source.frame(index))
+            match_start = time.perf_counter()
+            match_templates(frame, searches)
+            matching_time += time.perf_counter() - match_start
+    finally:
+        match_timer = previous_timer
+    frames_per_second = len(source) / matching_time if matching_time > 0 else 0
+    return frames_per_second, {name: sorted(values) for name, values in latencies.items()}
+
+def run_benchmark(path, mode_names, templates, speed=1.0):
+    """Prints detection speed, per-template latency and per-mode state accuracy for a recording."""
+    source = ReplaySource(path)
+    mode_names = mode_names or [source.mode or "1v1"]
     print("-" * 50)
-    print("  THE KING'S HAND - v1.0")
-    print("  Website: https://jlaiii.github.io/TKH/")
+    print(f"Replay Benchmark: {path} ({len(source)} frames)")
+    print("-" * 50)
+    for game_mode in mode_names:
+        searches = StateMachine(game_mode, game_modes, templates).all_searches()
+        frames_per_second, latencies = benchmark_detection(source, searches)
+        print(f"Mode {game_mode}: detection runs at {frames_per_second:.1f} frames per second")
+        print(f"  {'Template':<22}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+        for name, values in latencies.items():
+            print(f"  {name:<22}{percentile(values, 0.5) * 1000:>9.2f}{percentile(values, 0.95) * 1000:>9.2f}"
+                  f"{percentile(values, 0.99) * 1000:>9.2f}{(values[-1] if values else 0) * 1000:>9.2f}")
+
+        replay_source, observed, clicks = run_replay(path, game_mode, templates, speed)
+        accuracy = state_accuracy(replay_source, observed)
+        if accuracy is None:
+            print("  State accuracy: n/a (the recording has no states)")
+        else:
+            tick_accuracy, matched, recorded = accuracy
+            print(f"  State accuracy: {tick_accuracy * 100:.1f}% of ticks, {matched}/{recorded} recorded transitions reproduced")
+        print(f"  Clicks sent during replay: {len(clicks)}")
     print("-" * 50)
+
+def build_image_paths(asset_dir):
+    """
+    Returns the path of every image asset inside the given assets folder.
+    """
+    return {
+        'battle_button_image': os.path.join(asset_dir, 'battle_button.png'),
+        'ok_button_image': os.path.join(asset_dir, 'ok.png'),
+        'play_again_image': os.path.join(asset_dir, 'playagain.png'),
+        'two_v_two_end_image': os.path.join(asset_dir, '2v2end.png'),
+        'in_battle_image': os.path.join(asset_dir, 'inbattle.png'),
+        'game_window_image': os.path.join(asset_dir, 'crwindow.png')
+    }
+
+def load_assets(image_paths, pause_on_error=True):
+    """
+    Verifies and decodes every image asset, printing a report.
+    Exits the script if any asset is missing or unreadable, otherwise returns the TemplateRegistry.
+    """
     print("Verifying Image Assets...")
     
     found_assets, missing_assets = check_image_assets(image_paths)
@@ -426,24 +2948,319 @@ if __name__ == "__main__":
         print("ERROR: One or more critical image assets are missing. The script cannot function correctly.")
         print("Please download the missing files from the GitHub repository and place them in the 'assets' folder.")
         print("Repository link: https://jlaiii.github.io/TKH/")
+        if pause_on_error:
+            input("Press Enter to exit...")
+        sys.exit(1)
+
+    templates = TemplateRegistry()
+    template_errors = templates.load(image_paths)
+
+    if template_errors:
+        print("\nAssets Unreadable:")
+        for error in template_errors:
+            print(error)
+        print("\n" + "=" * 50)
+        print("ERROR: One or more image assets could not be decoded. The script cannot function correctly.")
+        print("Please download fresh copies of these files from the GitHub repository into the 'assets' folder.")
+        print("Repository link: https://jlaiii.github.io/TKH/")
+        if pause_on_error:
+            input("Press Enter to exit...")
+        sys.exit(1)
+
+    return templates
+
+def time_command(command, runs):
+    """
+    Runs a command in a fresh process the given number of times.
+    Returns the wall-clock time in seconds and the output of every run, in run order.
+    Raises RuntimeError if the command fails.
+    """
+    times = []
+    outputs = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        result = subprocess.run(command, capture_output=True, text=True)
+        times.append(time.perf_counter() - start_time)
+        if result.returncode != 0:
+            raise RuntimeError(f"'{' '.join(command)}' failed:\n{result.stdout}{result.stderr}")
+        outputs.append(result.stdout)
+    return times, outputs
+
+def format_timing(times):
+    sorted_times = sorted(times)
+    return f"{percentile(sorted_times, 0.5) * 1000:>8.0f}{sorted_times[0] * 1000:>8.0f}{sorted_times[-1] * 1000:>8.0f}"
+
+def run_startup_benchmark(asset_dir, modes_path, runs):
+    """
+    Times how long a fresh process takes to become ready to play, the way a
+    watchdog restart would: starting Python, importing this script and its
+    libraries, loading the assets and compiling the game modes. The bare
+    interpreter and the live input libraries, which load on the first capture,
+    are timed alongside for comparison.
+    """
+    check_command = [sys.executable, os.path.abspath(__file__), "--assets", asset_dir, "--modes", modes_path, "check", "--timings"]
+    interpreter_times, _ = time_command([sys.executable, "-c", "pass"], runs)
+    try:
+        check_times, outputs = time_command(check_command, runs)
+    except RuntimeError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    phases = [json.loads(output.splitlines()[-1]) for output in outputs]
+    asset_times = [phase["assets"] for phase in phases]
+    mode_times = [phase["modes"] for phase in phases]
+    # Whatever the run spent outside loading assets and modes: starting Python and importing
+    import_times = [total - phase["assets"] - phase["modes"] for total, phase in zip(check_times, phases)]
+    try:
+        live_times, _ = time_command([sys.executable, "-c", "import pyautogui, pydirectinput"], runs)
+    except RuntimeError:
+        live_times = None
+
+    print("-" * 50)
+    print(f"Startup Benchmark: {runs} runs")
+    print("-" * 50)
+    print(f"  {'Phase':<26}{'p50 ms':>8}{'min ms':>8}{'max ms':>8}")
+    print(f"  {'Python alone':<26}{format_timing(interpreter_times)}")
+    print(f"  {'Ready to play (check)':<26}{format_timing(check_times)}")
+    print(f"  {'  Python and imports':<26}{format_timing(import_times)}")
+    print(f"  {'  Loading assets':<26}{format_timing(asset_times)}")
+    print(f"  {'  Compiling game modes':<26}{format_timing(mode_times)}")
+    if live_times:
+        print(f"  {'Live input libraries':<26}{format_timing(live_times)}  (loaded on the first capture)")
+    else:
+        print(f"  {'Live input libraries':<26}     n/a  (pyautogui or pydirectinput cannot be imported here)")
+    print("-" * 50)
+
+def benchmark_capture(capture, seconds):
+    """
+    Captures as fast as possible for the given number of seconds, holding the
+    previous frame as the bot does. Returns (sorted capture latencies in seconds, frame shape).
+    """
+    latencies = []
+    rgb = capture()
+    end_time = time.perf_counter() + seconds
+    while time.perf_counter() < end_time:
+        capture_start = time.perf_counter()
+        rgb = capture()
+        latencies.append(time.perf_counter() - capture_start)
+    return sorted(latencies), rgb.shape
+
+def run_capture_benchmark(backend_names, path, seconds):
+    """
+    Compares how fast each capture backend grabs frames. The file backend is
+    timed decoding the recording's frames one after another rather than on its timeline.
+    """
+    print("-" * 50)
+    print(f"Capture Benchmark: {seconds:g} s per backend")
+    print("-" * 50)
+    print(f"  {'Backend':<12}{'fps':>8}{'p50 ms':>9}{'p95 ms':>9}  Frame")
+    for name in backend_names:
+        try:
+            if name == "file":
+                if not path:
+                    raise ValueError("needs a recording (--capture-file)")
+                source = ReplaySource(path)
+                indexes = itertools.cycle(range(len(source)))
+                capture = lambda: source.frame(next(indexes))
+            else:
+                capture = create_capture_backend(name)
+            latencies, shape = benchmark_capture(capture, seconds)
+        except Exception as e:
+            print(f"  {name:<12}unavailable: {e}")
+            continue
+        frames_per_second = len(latencies) / sum(latencies)
+        print(f"  {name:<12}{frames_per_second:>8.1f}{percentile(latencies, 0.5) * 1000:>9.2f}{percentile(latencies, 0.95) * 1000:>9.2f}"
+              f"  {shape[1]}x{shape[0]}")
+    print("-" * 50)
+
+def run_menu(image_paths, modes_path=MODES_FILE, capture=CAPTURE_BACKEND, capture_file=CAPTURE_FILE, checkpoint_path=CHECKPOINT_FILE, fresh=False):
+    """
+    Installs any missing libraries, shows the banner and the numbered mode menu,
+    then plays the chosen mode. This is what runs when TKH.py is double-clicked.
+    """
+    global game_modes, screen_source, checkpointer
+    if missing_packages({**CORE_PACKAGES, **LIVE_PACKAGES}):
+        install_dependencies({**CORE_PACKAGES, **LIVE_PACKAGES})
+    load_core_packages()
+    try:
+        screen_source = create_capture_backend(capture, capture_file)
+    except (ValueError, OSError) as e:
+        print(f"ERROR: Could not set up screen capture: {e}")
         input("Press Enter to exit...")
         sys.exit(1)
 
+    os.system('cls' if os.name == 'nt' else 'clear')
+    print("-" * 50)
+    print("  THE KING'S HAND - v1.0")
+    print("  Website: https://jlaiii.github.io/TKH/")
+    print("-" * 50)
+
+    templates = load_assets(image_paths)
+    game_modes = load_game_modes(templates, modes_path)
+    region_cache.load()
+    window_locator.template = templates['game_window_image']
+    if checkpoint_path:
+        checkpointer = Checkpointer(checkpoint_path)
+        if not fresh:
+            checkpointer.load()
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
+
     print("\n" + "=" * 50)
     print("All assets loaded successfully. The script is ready to run.")
     print("Choose a game mode to start the automation:")
-    print("1. 1v1 Mode (Classic)")
-    print("2. 2v2 Mode")
-    print("3. 1v1 Trophy Road Mode")
+    mode_names = list(game_modes)
+    for number, mode_name in enumerate(mode_names, 1):
+        print(f"{number}. {resolve_mode(game_modes, mode_name).get('title', mode_name)}")
     print("-" * 50)
     
+    choices = [str(number) for number in range(1, len(mode_names) + 1)]
     mode_selection = ""
-    while mode_selection not in ["1", "2", "3"]:
-        mode_selection = input("Enter 1, 2 or 3: ")
+    while mode_selection not in choices:
+        mode_selection = input(f"Enter {', '.join(choices[:-1])} or {choices[-1]}: " if len(choices) > 1 else "Enter 1: ")
     
-    if mode_selection == "1":
-        monitor_game_status("1v1", image_paths)
-    elif mode_selection == "2":
-        monitor_game_status("2v2", image_paths)
-    elif mode_selection == "3":
-        monitor_game_status("1v1_trophy_road", image_paths)
\ No newline at end of file
+    monitor_game_status(mode_names[int(mode_selection) - 1], templates)
+
+def main(argv):
+    """
+    The command-line entry point. With no command, shows the interactive mode menu.
+      run --mode MODE               play live in the game window
+      record DIR --mode MODE        play live and save the session to DIR
+      multi --mode MODE             play live in every game window on the desktop
+      replay PATH --mode MODE       run the bot on a recording, clicking nothing
+      benchmark PATH [--mode MODE]  report detection speed and state accuracy
+      check                         load the assets and game modes, then exit
+      install-deps                  install the required libraries with pip
+      startup-benchmark             time how long a fresh start takes to become ready
+      capture-benchmark             compare the frames per second of the capture backends
+    Only the menu installs libraries by itself; the commands never run pip unless asked.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(prog="TKH.py", description="The King's Hand command-line tools.")
+    parser.add_argument("--assets", default=os.path.join(script_dir, 'assets'), help="Folder holding the image assets.")
+    parser.add_argument("--modes", default=MODES_FILE, help="File of extra game mode definitions (.json or .yaml).")
+    parser.add_argument("--log-file", default=LOG_FILE, help="File to write the log to.")
+    parser.add_argument("--capture", choices=CAPTURE_BACKENDS, default=CAPTURE_BACKEND, help="Where live screenshots come from.")
+    parser.add_argument("--capture-file", default=CAPTURE_FILE, help="Recording played as the screen by the file capture backend.")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="File live sessions save their progress to and resume from.")
+    parser.add_argument("--fresh", action="store_true", help="Start counters and state from zero instead of resuming the checkpoint.")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="Play live in the game window.")
+    run_parser.add_argument("--mode", required=True)
+    run_parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus metrics on this port.")
+    record_parser = commands.add_parser("record", help="Play live and save the session as a replay.")
+    record_parser.add_argument("directory")
+    record_parser.add_argument("--mode", required=True)
+    record_parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus metrics on this port.")
+    multi_parser = commands.add_parser("multi", help="Play live in several game windows at once.")
+    multi_parser.add_argument("--mode", required=True)
+    multi_parser.add_argument("--windows", type=int, default=MAX_GAME_WINDOWS, help="Most game windows to drive.")
+    multi_parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus metrics on this port.")
+    replay_parser = commands.add_parser("replay", help="Run the bot on a recorded directory or video.")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--mode")
+    replay_parser.add_argument("--speed", type=float, default=1.0)
+    replay_parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus metrics on this port.")
+    benchmark_parser = commands.add_parser("benchmark", help="Benchmark detection on a recorded directory or video.")
+    benchmark_parser.add_argument("path")
+    benchmark_parser.add_argument("--mode", action="append", help="May be given more than once.")
+    benchmark_parser.add_argument("--speed", type=float, default=1.0)
+    check_parser = commands.add_parser("check", help="Load the assets and game modes, then exit.")
+    check_parser.add_argument("--timings", action="store_true", help="Print the load times as JSON.")
+    install_parser = commands.add_parser("install-deps", help="Install the required libraries with pip.")
+    install_parser.add_argument("--optional", action="store_true", help="Also install PyYAML, pygetwindow and mss.")
+    startup_parser = commands.add_parser("startup-benchmark", help="Time how long a fresh start takes to become ready.")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    capture_parser = commands.add_parser("capture-benchmark", help="Compare the frames per second of the capture backends.")
+    capture_parser.add_argument("--backend", action="append", choices=CAPTURE_BACKENDS[1:], help="May be given more than once; defaults to all of them.")
+    capture_parser.add_argument("--seconds", type=float, default=3.0, help="How long to capture with each backend.")
+    global screen_source, click_sink, game_modes, checkpointer
+    args = parser.parse_args(argv)
+    log_writer.path = args.log_file
+    image_paths = build_image_paths(args.assets)
+
+    if args.command is None:
+        run_menu(image_paths, args.modes, args.capture, args.capture_file, args.checkpoint, args.fresh)
+        return
+    if args.command == "install-deps":
+        install_dependencies({**CORE_PACKAGES, **LIVE_PACKAGES, **(OPTIONAL_PACKAGES if args.optional else {})})
+        return
+    if args.command == "startup-benchmark":
+        run_startup_benchmark(args.assets, args.modes, args.runs)
+        return
+
+    live = args.command in ("run", "record", "multi")
+    required_packages = dict(CORE_PACKAGES)
+    if live:
+        required_packages.update(capture_packages(args.capture), pydirectinput=LIVE_PACKAGES['pydirectinput'])
+    missing = missing_packages(required_packages)
+    if missing:
+        print(f"ERROR: Missing libraries: {', '.join(missing)}. Install them with 'python TKH.py install-deps'.")
+        sys.exit(1)
+    if args.command == "capture-benchmark":
+        # The file backend is only compared when there is a recording to play
+        backend_names = args.backend or [name for name in CAPTURE_BACKENDS[1:] if name != "file" or args.capture_file]
+        run_capture_benchmark(backend_names, args.capture_file, args.seconds)
+        return
+    if live:
+        try:
+            screen_source = create_capture_backend(args.capture, args.capture_file)
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+        if args.checkpoint:
+            checkpointer = Checkpointer(args.checkpoint)
+            if not args.fresh:
+                checkpointer.load()
+
+    start_time = time.perf_counter()
+    templates = load_assets(image_paths, pause_on_error=False)
+    assets_loaded_time = time.perf_counter()
+    game_modes = load_game_modes(templates, args.modes, pause_on_error=False)
+    modes_loaded_time = time.perf_counter()
+    requested_modes = getattr(args, "mode", None) or []
+    if not isinstance(requested_modes, list):
+        requested_modes = [requested_modes]
+    for mode in requested_modes:
+        if mode not in game_modes:
+            parser.error(f"unknown mode '{mode}' (choose from {', '.join(game_modes)})")
+    if getattr(args, "metrics_port", None) is not None:
+        start_metrics_server(args.metrics_port)
+
+    if args.command == "run":
+        region_cache.load()
+        window_locator.template = templates['game_window_image']
+        monitor_game_status(args.mode, templates)
+    elif args.command == "record":
+        region_cache.load()
+        window_locator.template = templates['game_window_image']
+        recorder = SessionRecorder(args.directory, args.mode, screen_source, click_sink)
+        screen_source = recorder.capture
+        click_sink = recorder.click
+        try:
+            monitor_game_status(args.mode, templates, observer=recorder.observe)
+        finally:
+            recorder.close()
+    elif args.command == "multi":
+        MultiWindowRunner(args.mode, templates, args.windows).run()
+    elif args.command == "replay":
+        game_mode = args.mode or ReplaySource(args.path).mode or "1v1"
+        source, observed, clicks = run_replay(args.path, game_mode, templates, args.speed)
+        accuracy = state_accuracy(source, observed)
+        print("-" * 50)
+        print(f"Replay finished: {len(observed)} ticks, {len(clicks)} clicks recorded.")
+        if accuracy:
+            tick_accuracy, matched, recorded = accuracy
+            print(f"State accuracy: {tick_accuracy * 100:.1f}% of ticks, {matched}/{recorded} recorded transitions reproduced")
+    elif args.command == "benchmark":
+        run_benchmark(args.path, args.mode, templates, args.speed)
+    elif args.command == "check":
+        if args.timings:
+            print(json.dumps({
+                "assets": assets_loaded_time - start_time,
+                "modes": modes_loaded_time - assets_loaded_time
+            }))
+        else:
+            print(f"Ready: {len(game_modes)} game modes loaded in {(modes_loaded_time - start_time) * 1000:.0f} ms.")
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    main(sys.argv[1:])